@@ -0,0 +1,62 @@
+# ***************************************************************************
+# Copyright (c) 2024 SAP SE or an SAP affiliate company. All rights reserved.
+# ***************************************************************************
+# This sample code is provided AS IS, without warranty or liability
+# of any kind.
+#
+# You may use, reproduce, modify and distribute this sample code
+# without limitation, on the condition that you retain the foregoing
+# copyright notice and disclaimer as to the original code.
+#
+# ***************************************************************************
+"""Measure how long a fresh interpreter takes to import sqlanydb and to
+make its first connection.
+
+    python bench_startup.py [-n RUNS] ["uid=dba;pwd=sql;..."]
+
+Each run is a new process, so nothing is cached between runs except by the
+operating system.  Without a connection string only the import is timed.
+"""
+import os
+import subprocess
+import sys
+
+CHILD = r'''
+import sys, time
+start = time.time()
+import sqlanydb
+imported = time.time()
+if len(sys.argv) > 1:
+    kwargs = dict(p.split('=', 1) for p in sys.argv[1].split(';') if p)
+    sqlanydb.connect(**kwargs).close()
+connected = time.time()
+print('%f %f' % (imported - start, connected - imported))
+'''
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def run(runs, params):
+    # run in the directory above this script, so that its sqlanydb is the
+    # one imported
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    args = [sys.executable, '-c', CHILD] + params
+    imports, connects = [], []
+    for i in range(runs):
+        out = subprocess.check_output(args, cwd=root)
+        imported, connected = out.split()
+        imports.append(float(imported))
+        connects.append(float(connected))
+    return median(imports), median(connects)
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    runs = 20
+    if argv[:1] == ['-n']:
+        runs = int(argv[1])
+        argv = argv[2:]
+    imported, connected = run(runs, argv[:1])
+    print('import sqlanydb:  %8.2f ms' % (imported * 1000))
+    if argv:
+        print('first connect():  %8.2f ms' % (connected * 1000))
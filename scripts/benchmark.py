@@ -0,0 +1,214 @@
+# ***************************************************************************
+# Copyright (c) 2024 SAP SE or an SAP affiliate company. All rights reserved.
+# ***************************************************************************
+# This sample code is provided AS IS, without warranty or liability
+# of any kind.
+#
+# You may use, reproduce, modify and distribute this sample code
+# without limitation, on the condition that you retain the foregoing
+# copyright notice and disclaimer as to the original code.
+#
+# ***************************************************************************
+"""Measure the overhead of sqlanydb without a database server.
+
+The driver is run against stub_dbcapi.c, a stand-in dbcapi library that
+makes up result sets and accepts any parameters, so the figures are the
+cost of the driver itself.  The library is built with the C compiler
+named by $CC (cc by default) unless --library gives one.
+
+    python benchmark.py [-n REPEAT] [--driver DIR] [--save FILE]
+                        [--compare FILE] [--threshold FRACTION]
+                        [NAME ...]
+
+Each benchmark runs REPEAT times and its fastest run is reported.  --save
+writes the results as JSON; --compare reads results saved earlier, from
+another release say, and exits with status 1 if any benchmark has become
+slower by more than the threshold (10% by default).  --driver imports
+sqlanydb from DIR instead of from this source tree.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+clock = getattr(time, 'perf_counter', time.time)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STUB_SOURCE = os.path.join(HERE, 'stub_dbcapi.c')
+
+def build_stub():
+    """Compile the stub library, unless it is up to date, and return its
+    path."""
+    build_dir = os.path.join(tempfile.gettempdir(), 'sqlanydb-benchmark')
+    library = os.path.join(build_dir, 'libdbcapi_stub.so')
+    if (not os.path.exists(library) or
+            os.path.getmtime(library) < os.path.getmtime(STUB_SOURCE)):
+        if not os.path.isdir(build_dir):
+            os.makedirs(build_dir)
+        cc = os.environ.get('CC', 'cc')
+        subprocess.check_call([cc, '-O2', '-shared', '-fPIC', '-o', library,
+                               STUB_SOURCE])
+    return library
+
+def fetchall(sqlanydb, con):
+    cur = con.cursor()
+    cur.execute('SYNTH 200000 iIbdsS')
+    return len(cur.fetchall()), 'rows'
+
+def fetchall_narrow(sqlanydb, con):
+    cur = con.cursor()
+    cur.rowset_size = 1
+    cur.execute('SYNTH 20000 iIbdsS')
+    return len(cur.fetchall()), 'rows'
+
+def fetchmany(sqlanydb, con):
+    cur = con.cursor()
+    cur.execute('SYNTH 200000 iIbdsS')
+    n = 0
+    while True:
+        rows = cur.fetchmany(100)
+        if not rows:
+            return n, 'rows'
+        n += len(rows)
+
+def iterate(sqlanydb, con):
+    cur = con.cursor()
+    cur.execute('SYNTH 200000 iIbdsS')
+    n = 0
+    for row in cur:
+        n += 1
+    return n, 'rows'
+
+def fetch_numpy(sqlanydb, con):
+    cur = con.cursor()
+    cur.execute('SYNTH 1000000 iIbd')
+    columns = cur.fetch_numpy()
+    return len(list(columns.values())[0]), 'rows'
+
+def executemany(sqlanydb, con):
+    cur = con.cursor()
+    rows = [(i, 'row %d' % i, i * 0.5) for i in range(100000)]
+    cur.executemany('insert into t values (?, ?, ?)', rows)
+    return len(rows), 'rows'
+
+def lob_fetch(sqlanydb, con):
+    cur = con.cursor()
+    cur.execute('SYNTH 200 il 1000000')
+    return sum(len(row[1]) for row in cur.fetchall()), 'bytes'
+
+def lob_stream(sqlanydb, con):
+    cur = con.cursor()
+    cur.stream_long_columns = True
+    cur.setoutputsize(1 << 16)
+    cur.execute('SYNTH 50 il 4000000')
+    n = 0
+    for row in cur:
+        for chunk in row[1].chunks():
+            n += len(chunk)
+    return n, 'bytes'
+
+def cached_query(sqlanydb, con):
+    if not hasattr(sqlanydb, 'ResultCache'):
+        raise AttributeError('no result cache')
+    cached = sqlanydb.connect(uid='dba', pwd='sql',
+                              result_cache_size=1 << 20)
+    try:
+        cur = cached.cursor()
+        for i in range(20000):
+            cur.execute('select SYNTH 100 iIbdsS from t where k = ?',
+                        (i % 10,))
+            cur.fetchall()
+    finally:
+        cached.close()
+    return 20000, 'queries'
+
+def connect(sqlanydb, con):
+    for i in range(500):
+        sqlanydb.connect(uid='dba', pwd='sql').close()
+    return 500, 'connects'
+
+BENCHMARKS = [fetchall, fetchall_narrow, fetchmany, iterate, fetch_numpy,
+              executemany, lob_fetch, lob_stream, cached_query, connect]
+
+def run(sqlanydb, names, repeat):
+    results = {}
+    con = sqlanydb.connect(uid='dba', pwd='sql')
+    try:
+        for benchmark in BENCHMARKS:
+            name = benchmark.__name__
+            if names and name not in names:
+                continue
+            best = None
+            try:
+                for i in range(repeat):
+                    start = clock()
+                    count, unit = benchmark(sqlanydb, con)
+                    elapsed = clock() - start
+                    if best is None or elapsed < best:
+                        best = elapsed
+            except (ImportError, AttributeError, TypeError,
+                    sqlanydb.NotSupportedError) as e:
+                # not supported by this version of the driver, or numpy
+                # is not installed
+                sys.stderr.write('%s skipped: %s\n' % (name, e))
+                continue
+            results[name] = dict(count=count, unit=unit, seconds=best,
+                                 rate=count / best)
+    finally:
+        con.close()
+    return results
+
+def report(results, baseline, threshold):
+    """Print the results, against baseline if given.  Returns the names
+    of the benchmarks that have become slower by more than threshold."""
+    regressions = []
+    for name in sorted(results):
+        result = results[name]
+        line = '%-16s %12.0f %-8s/s %9.3f s' % (name, result['rate'],
+                                                result['unit'],
+                                                result['seconds'])
+        if baseline and name in baseline:
+            change = result['rate'] / baseline[name]['rate'] - 1
+            line += '  %+6.1f%%' % (change * 100)
+            if change < -threshold:
+                line += '  REGRESSION'
+                regressions.append(name)
+        print(line)
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark sqlanydb against a stub dbcapi library.')
+    parser.add_argument('names', nargs='*', metavar='NAME',
+                        help='benchmarks to run: %s' %
+                        ', '.join(b.__name__ for b in BENCHMARKS))
+    parser.add_argument('-n', '--repeat', type=int, default=5)
+    parser.add_argument('--driver', default=os.path.dirname(HERE),
+                        help='directory to import sqlanydb from')
+    parser.add_argument('--library', help='stub library to use')
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--compare', help='results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.10)
+    args = parser.parse_args()
+
+    os.environ['SQLANY_API_DLL'] = args.library or build_stub()
+    sys.path.insert(0, args.driver)
+    import sqlanydb
+
+    results = run(sqlanydb, args.names, args.repeat)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    regressions = report(results, baseline, args.threshold)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(dict(version=sqlanydb.__version__,
+                           python=platform.python_version(),
+                           platform=platform.platform(),
+                           results=results), f, indent=2, sort_keys=True)
+    sys.exit(1 if regressions else 0)
@@ -15,6 +15,7 @@
 # discouraged in production code.  A best practice for production
 # code would be to prompt the user for the userid and password.
 # ***************************************************************************
+import io
 import sys
 import sqlanydb
 import dbapi20
@@ -28,6 +29,407 @@ class test_sqlanydb(dbapi20.DatabaseAPI20Test):
     def test_setoutputsize(self): pass
     def test_setoutputsize_basic(self): pass
 
+    def test_converter(self):
+        con = self._connect()
+        try:
+            cur = con.cursor()
+            self.driver.register_converter(self.driver.DT_DECIMAL,
+                                           lambda v: v and float(v))
+            try:
+                cur.execute("select 1.5, cast(2.5 as double), "
+                            "cast(null as numeric)")
+                self.assertEqual(cur.fetchone(), (1.5, 2.5, None))
+            finally:
+                del self.driver.CONVERSION_CALLBACKS[self.driver.DT_DECIMAL]
+        finally:
+            con.close()
+
+    def test_binary_views(self):
+        con = self._connect()
+        try:
+            cur = con.cursor()
+            cur.binary_views = True
+            cur.execute("select cast('abc' as binary(3)), "
+                        "cast(null as long binary)")
+            row = cur.fetchone()
+            self.assertTrue(isinstance(row[0], memoryview))
+            self.assertTrue(row[0].readonly)
+            self.assertEqual(bytes(row[0]), b'abc')
+            self.assertEqual(row[1], None)
+        finally:
+            con.close()
+
+    def test_column_reader(self):
+        con = self._connect()
+        try:
+            cur = con.cursor()
+            cur.stream_long_columns = True
+            cur.setoutputsize(1000)
+            cur.execute("select repeat('x', 2500), "
+                        "cast(repeat('y', 10) as long binary), "
+                        "cast(null as long binary)")
+            text, blob, null = cur.fetchone()
+            self.assertEqual(len(text), 2500)
+            self.assertEqual([len(c) for c in text.chunks()], [1000, 1000, 500])
+            self.assertEqual(blob.read(4), b'yyyy')
+            blob.seek(0)
+            self.assertEqual(blob.read(), b'y' * 10)
+            self.assertEqual(null, None)
+            cur.fetchone()
+            self.assertRaises(sqlanydb.InterfaceError, blob.read)
+        finally:
+            con.close()
+
+    def test_setoutputsize_hint(self):
+        con = self._connect()
+        try:
+            cur = con.cursor()
+            cur.setoutputsize(1000)
+            cur.execute("select cast(repeat('x', 2500) as long varchar), "
+                        "cast(repeat('y', 10) as long binary)")
+            self.assertEqual(cur.fetchall(), [('x' * 2500, b'y' * 10)])
+        finally:
+            con.close()
+
+    def test_wide_fetch(self):
+        con = self._connect()
+        try:
+            cur = con.cursor()
+            cur.rowset_size = 7
+            cur.execute("select row_num, cast(row_num as varchar(10)), "
+                        "if mod(row_num, 3) = 0 then null endif "
+                        "from sa_rowgenerator(1, 100)")
+            rows = [cur.fetchone()] + cur.fetchmany(10) + cur.fetchall()
+            self.assertEqual(len(rows), 100)
+            for i, row in enumerate(rows, 1):
+                self.assertEqual(row, (i, str(i), None if i % 3 == 0 else i))
+        finally:
+            con.close()
+
+    def test_iteration(self):
+        con = self._connect()
+        try:
+            cur = con.cursor()
+            cur.rowset_size = 4
+            cur.execute("select row_num from sa_rowgenerator(1, 10)")
+            self.assertEqual(cur.fetchone(), (1,))
+            self.assertEqual(cur.fetchmany(2), [(2,), (3,)])
+            self.assertEqual(next(cur), (4,))
+            self.assertEqual([row for row in cur], [(i,) for i in range(5, 11)])
+            self.assertEqual(cur.fetchone(), None)
+        finally:
+            con.close()
+
+    def test_spooled_fetchall(self):
+        con = self._connect()
+        try:
+            cur = con.cursor()
+            cur.execute("select row_num, 'row ' || row_num "
+                        "from sa_rowgenerator(1, 5000)")
+            rows = cur.fetchall(spill_threshold=1000)
+            try:
+                self.assertTrue(rows.spilled())
+                self.assertEqual(len(rows), 5000)
+                self.assertEqual(rows[-1], (5000, 'row 5000'))
+                self.assertEqual(list(rows)[:2], [(1, 'row 1'), (2, 'row 2')])
+            finally:
+                rows.close()
+        finally:
+            con.close()
+
+    def test_fetch_numpy(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest('numpy is not installed')
+        con = self._connect()
+        try:
+            cur = con.cursor()
+            cur.execute("select row_num as n, row_num / 2.0e0 as half, "
+                        "if mod(row_num, 2) = 0 then null "
+                        "else cast(row_num as varchar(10)) endif as s "
+                        "from sa_rowgenerator(1, 10)")
+            batch = cur.fetch_numpy(batch_rows=4)
+            self.assertEqual(list(batch['n']), [1, 2, 3, 4])
+            rest = cur.fetch_numpy(structured=True)
+            self.assertEqual(len(rest), 6)
+            self.assertEqual(rest['half'][-1], 5.0)
+            self.assertEqual(list(rest['s'].mask), [True, False] * 3)
+            self.assertEqual(len(cur.fetch_numpy()['n']), 0)
+        finally:
+            con.close()
+
+    def test_fetch_arrow_batches(self):
+        try:
+            import pyarrow
+        except ImportError:
+            self.skipTest('pyarrow is not installed')
+        con = self._connect()
+        try:
+            cur = con.cursor()
+            cur.execute("select row_num as n, "
+                        "if mod(row_num, 2) = 0 then null "
+                        "else cast(row_num as varchar(10)) endif as s "
+                        "from sa_rowgenerator(1, 10)")
+            reader = pyarrow.RecordBatchReader.from_stream(
+                cur.fetch_arrow_batches(batch_rows=4))
+            batches = list(reader)
+            self.assertEqual([b.num_rows for b in batches], [4, 4, 2])
+            table = pyarrow.Table.from_batches(batches)
+            self.assertEqual(table.column('n').to_pylist(), list(range(1, 11)))
+            self.assertEqual(table.column('s').null_count, 5)
+            self.assertEqual(table.column('s')[0].as_py(), '1')
+        finally:
+            con.close()
+
+    def test_background_prefetch(self):
+        con = self._connect()
+        try:
+            cur = con.cursor()
+            cur.background_prefetch = True
+            cur.rowset_size = 16
+            cur.execute("select row_num from sa_rowgenerator(1, 100)")
+            self.assertEqual(cur.fetchmany(10), [(i,) for i in range(1, 11)])
+            self.assertEqual(len(cur.fetchall()), 90)
+            cur.execute("select row_num from sa_rowgenerator(1, 100)")
+            self.assertEqual(cur.fetchone(), (1,))
+            cur.execute("select 'abc'")
+            self.assertEqual(cur.fetchall(), [('abc',)])
+        finally:
+            con.close()
+
+    def test_batched_executemany(self):
+        con = self._connect()
+        try:
+            cur = con.cursor()
+            self.executeDDL1(cur)
+            rows = [('name %d' % i,) for i in range(2500)] + [(None,)]
+            cur.executemany('insert into %sbooze values (?)' %
+                            self.table_prefix, rows)
+            self.assertEqual(cur.rowcount, len(rows))
+            cur.execute('select name from %sbooze order by 1' %
+                        self.table_prefix)
+            self.assertEqual(sorted(cur.fetchall()), sorted(rows))
+        finally:
+            con.close()
+
+    def test_declared_char_set(self):
+        kwargs = dict(self.connect_kw_args, CharSet='utf-8', char_set='utf-8')
+        con = self.driver.connect(*self.connect_args, **kwargs)
+        try:
+            self.assertEqual(con.char_set, 'utf-8')
+            cur = con.cursor()
+            cur.execute("select ?", (u'\u00e9t\u00e9',))
+            self.assertEqual(cur.fetchone(), (u'\u00e9t\u00e9',))
+        finally:
+            con.close()
+
+    def test_statement_cache(self):
+        kwargs = dict(self.connect_kw_args, statement_cache_size=2)
+        con = self.driver.connect(*self.connect_args, **kwargs)
+        try:
+            cur = con.cursor()
+            for i in range(5):
+                cur.execute('select ?', (i,))
+                self.assertEqual(cur.fetchone(), (i,))
+            cache = con.statement_cache
+            self.assertEqual(cache.hits, 4)
+            self.assertTrue(len(cache) <= 2)
+        finally:
+            con.close()
+
+    def test_result_cache(self):
+        kwargs = dict(self.connect_kw_args, result_cache_size=1 << 20)
+        con = self.driver.connect(*self.connect_args, **kwargs)
+        try:
+            cur = con.cursor()
+            self.executeDDL1(cur)
+            con.commit()
+            query = 'select name from %sbooze where name = ?' % (
+                self.table_prefix)
+            for i in range(2):
+                cur.execute(query, ('Victoria Bitter',))
+                self.assertEqual(cur.fetchall(), [])
+            cache = con.result_cache
+            self.assertEqual(cache.hits, 1)
+            cur.execute("insert into %sbooze values ('Victoria Bitter')" % (
+                self.table_prefix))
+            self.assertEqual(len(cache), 0)
+            cur.execute(query, ('Victoria Bitter',))
+            self.assertEqual(cur.fetchall(), [('Victoria Bitter',)])
+        finally:
+            con.close()
+
+    def test_rebind(self):
+        con = self._connect()
+        try:
+            cur = con.cursor()
+            self.executeDDL1(cur)
+            values = ['a', 'b' * 20, None, 'c', 'd' * 10]
+            for value in values:
+                cur.execute('insert into %sbooze values (?)' %
+                            self.table_prefix, (value,))
+            cur.execute('select name from %sbooze' % self.table_prefix)
+            self.assertEqual(sorted(cur.fetchall(), key=str),
+                             sorted([(v,) for v in values], key=str))
+        finally:
+            con.close()
+
+    def test_streamed_parameters(self):
+        con = self._connect()
+        try:
+            cur = con.cursor()
+            cur.execute('create table %sblobs (id int, data long binary)' %
+                        self.table_prefix)
+            data = bytes(bytearray(range(256))) * 1000
+            chunks = (data[i:i+1000] for i in range(0, len(data), 1000))
+            cur.executemany('insert into %sblobs values (?, ?)' %
+                            self.table_prefix,
+                            [(1, io.BytesIO(data)),
+                             (2, memoryview(bytearray(data))),
+                             (3, chunks)])
+            self.assertEqual(cur.rowcount, 3)
+            cur.execute('select data from %sblobs order by id' %
+                        self.table_prefix)
+            self.assertEqual(cur.fetchall(), [(data,)] * 3)
+        finally:
+            con.close()
+
+    def test_async(self):
+        try:
+            import asyncio
+        except ImportError:
+            self.skipTest('asyncio is not available')
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        run = loop.run_until_complete
+        try:
+            con = run(self.driver.connect_async(*self.connect_args,
+                                                **self.connect_kw_args))
+            try:
+                cur = con.cursor()
+                cur.rowset_size = 3
+                run(cur.execute("select row_num from sa_rowgenerator(1, 10)"))
+                self.assertEqual(run(cur.fetchone()), (1,))
+                self.assertEqual(run(cur.__anext__()), (2,))
+                self.assertEqual(len(run(cur.fetchall())), 8)
+                self.assertRaises(self.driver.DatabaseError, run,
+                                  cur.execute("select * from nonexistent"))
+            finally:
+                run(con.close())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    def test_hooks(self):
+        con = self._connect()
+        try:
+            events = []
+            for event in self.driver.HOOK_EVENTS:
+                con.add_hook(event, events.append)
+            cur = con.cursor()
+            cur.execute("select row_num from sa_rowgenerator(1, 10)")
+            self.assertEqual(len(cur.fetchall()), 10)
+            con.commit()
+            names = [info['event'] for info in events]
+            self.assertEqual(names[:2], ['on_prepare', 'on_execute'])
+            self.assertEqual(names[-1], 'on_commit')
+            batches = [info for info in events
+                       if info['event'] == 'on_fetch_batch']
+            self.assertEqual(sum(info['rows'] for info in batches), 10)
+            self.assertTrue(all(info['cursor'] is cur for info in batches))
+            con.remove_hook('on_error', events.append)
+            del events[:]
+            self.assertRaises(self.driver.DatabaseError, cur.execute,
+                              "select * from nonexistent")
+            self.assertEqual([info['event'] for info in events],
+                             ['on_prepare'])
+        finally:
+            con.close()
+
+    def test_profile(self):
+        con = self._connect()
+        try:
+            cur = con.cursor()
+            out = io.StringIO()
+            with self.driver.profile(out) as profile:
+                cur.execute("select row_num from sa_rowgenerator(1, 10)")
+                self.assertEqual(len(cur.fetchall()), 10)
+            self.assertTrue(profile.stats()['sqlany_fetch_next'][0] >= 1)
+            self.assertEqual(len(profile.cursors), 1)
+            self.assertTrue('sqlany_execute' in out.getvalue())
+        finally:
+            con.close()
+
+    def test_shared_connection(self):
+        import threading
+        con = self._connect()
+        try:
+            results = []
+            def select(n):
+                cur = con.cursor()
+                try:
+                    cur.execute("select row_num from sa_rowgenerator(1, ?)",
+                                (n,))
+                    results.append(len(cur.fetchall()) == n)
+                finally:
+                    cur.close()
+            threads = [threading.Thread(target=select, args=(1000 + i,))
+                       for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(results, [True] * 4)
+        finally:
+            con.close()
+
+    def test_query_timeout(self):
+        con = self._connect()
+        try:
+            cur = con.cursor()
+            self.assertRaises(self.driver.QueryTimeoutError, cur.execute,
+                              "waitfor delay '00:00:30'", timeout=0.5)
+            cur.execute('select 1', timeout=30)
+            self.assertEqual(cur.fetchone(), (1,))
+        finally:
+            con.close()
+
+    def test_connection_pool(self):
+        pool = self.driver.ConnectionPool(max_size=1, timeout=0.1,
+                                          **self.connect_kw_args)
+        try:
+            with pool.acquire() as cur:
+                raw = cur.parent
+                cur.execute('select 1')
+                self.assertEqual(cur.fetchone(), (1,))
+                self.assertRaises(self.driver.PoolTimeoutError, pool.acquire)
+            con = pool.acquire()
+            self.assertTrue(con.connection is raw)
+            con.close()
+            stats = pool.stats()
+            self.assertEqual((stats['created'], stats['checkouts'],
+                              stats['timeouts']), (1, 2, 1))
+        finally:
+            pool.close()
+
+    def test_setinputsizes_types(self):
+        con = self._connect()
+        try:
+            cur = con.cursor()
+            self.executeDDL1(cur)
+            cur.setinputsizes((str,))
+            cur.executemany('insert into %sbooze values (?)' %
+                            self.table_prefix, [(1,), (22,), (None,)])
+            cur.setinputsizes((20,))
+            cur.execute('insert into %sbooze values (?)' % self.table_prefix,
+                        ('Cooper\'s',))
+            cur.execute('select name from %sbooze' % self.table_prefix)
+            self.assertEqual(sorted(cur.fetchall(), key=str),
+                             [('1',), ('22',), ("Cooper's",), (None,)])
+        finally:
+            con.close()
+
 if __name__ == '__main__':
     unittest.main()
     print('''Done''')
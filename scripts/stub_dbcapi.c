@@ -0,0 +1,906 @@
+/* ***************************************************************************
+ * Copyright (c) 2024 SAP SE or an SAP affiliate company. All rights reserved.
+ * ***************************************************************************
+ */
+/*
+ * Stand-in for the SQL Anywhere dbcapi client library.
+ *
+ * Implements enough of sacapi.h (API versions 1, 2 and 4) to drive sqlanydb
+ * without a database server.  Statements are interpreted as follows:
+ *
+ *   SYNTH <rows> <cols> [<longsize> [<ms>]]
+ *                                      synthetic result set; <cols> is a
+ *                                      string of column type letters, see
+ *                                      column_spec() below; the first fetch
+ *                                      waits <ms>, honouring sqlany_cancel
+ *   select SYNTH <rows> <cols> from <table>
+ *                                      the same, as a query naming a table
+ *   SYNTH STATS                        one row of counters (inserted rows,
+ *                                      sum of integer parameters, parameter
+ *                                      bytes, streamed bytes, prepares,
+ *                                      executes)
+ *   SLEEP <ms>                         waits, honouring sqlany_cancel
+ *   BAD ...                            fails to prepare (SQLCODE -131)
+ *   select connection_property('CharSet')   returns 'UTF-8'
+ *
+ * Any other statement executes successfully; statements containing '?'
+ * parameter markers consume their bound parameters, one row per execute or
+ * one batch per execute when a batch size has been set.  Connecting fails
+ * if the connection string contains pwd=wrong.
+ *
+ * Environment variables:
+ *
+ *   STUB_DBCAPI_VERSION     highest API version offered (default 4)
+ *   STUB_FETCH_LATENCY_US   microseconds each sqlany_fetch_next sleeps,
+ *                           to stand in for a network round trip
+ *   STUB_ROWSET_SIZE_FAILS  n: the nth call on a statement of
+ *                           sqlany_set_rowset_size for more than one
+ *                           row fails
+ *   STUB_WARN_EVERY         n: a fetch of every nth row, or of a rowset
+ *                           holding one, succeeds with warning 101
+ *
+ * Build it with
+ *
+ *   cc -O2 -shared -fPIC -o libdbcapi_stub.so stub_dbcapi.c
+ *
+ * and load it by setting SQLANY_API_DLL to the path of the library.
+ * scripts/benchmark.py does both.
+ */
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+
+#ifdef _WIN32
+#define EXPORT __declspec(dllexport)
+#else
+#define EXPORT __attribute__((visibility("default")))
+#endif
+
+typedef int sacapi_i32;
+typedef unsigned int sacapi_u32;
+typedef sacapi_i32 sacapi_bool;
+
+enum { A_INVALID_TYPE, A_BINARY, A_STRING, A_DOUBLE, A_VAL64, A_UVAL64,
+       A_VAL32, A_UVAL32, A_VAL16, A_UVAL16, A_VAL8, A_UVAL8 };
+
+enum { DT_TIMESTAMP = 392, DT_VARCHAR = 448, DT_LONGVARCHAR = 456,
+       DT_DOUBLE = 480, DT_DECIMAL = 484, DT_INT = 496, DT_SMALLINT = 500,
+       DT_BINARY = 524, DT_LONGBINARY = 528, DT_BIGINT = 608,
+       DT_UNSBIGINT = 620, DT_BIT = 624 };
+
+typedef struct {
+    char *buffer;
+    size_t buffer_size;
+    size_t *length;
+    int type;
+    sacapi_bool *is_null;
+} data_value2;
+
+typedef struct {
+    char *buffer;
+    size_t buffer_size;
+    size_t *length;
+    int type;
+    sacapi_bool *is_null;
+    sacapi_bool is_address;
+} data_value4;
+
+typedef struct {
+    int direction;
+    data_value2 value;
+    char *name;
+} bind_param2;
+
+typedef struct {
+    int direction;
+    data_value4 value;
+    char *name;
+} bind_param4;
+
+typedef struct {
+    char *name;
+    int type;
+    int native_type;
+    unsigned short precision;
+    unsigned short scale;
+    size_t max_size;
+    sacapi_bool nullable;
+} column_info2;
+
+typedef struct {
+    char *name;
+    int type;
+    int native_type;
+    unsigned short precision;
+    unsigned short scale;
+    size_t max_size;
+    sacapi_bool nullable;
+    char *table_name;
+    char *owner_name;
+    sacapi_bool is_bound;
+    data_value4 binding;
+} column_info4;
+
+typedef struct {
+    int index;
+    int type;
+    sacapi_bool is_null;
+    size_t data_size;
+} data_info;
+
+typedef struct {
+    int version;
+} context;
+
+typedef struct {
+    int version;
+    int connected;
+    sacapi_i32 code;
+    char message[256];
+    char state[6];
+    volatile int cancelled;
+    long long inserted;
+    long long int_sum;
+    long long param_bytes;
+    long long streamed;
+    long long prepares;
+    long long executes;
+} connection;
+
+#define MAXCOLS 64
+#define MAXPARAMS 64
+
+enum { K_OTHER, K_SYNTH, K_STATS, K_CHARSET, K_SLEEP };
+
+typedef struct {
+    connection *conn;
+    int kind;
+    int executed;
+    int nrows;
+    int ncols;
+    char cols[MAXCOLS + 1];
+    size_t longsize;
+    int sleep_ms;
+    long long stats[6];
+    int row;                    /* current row, -1 before the first */
+    int nparams;
+    data_value4 params[MAXPARAMS];
+    int bound[MAXPARAMS];
+    long long streamed[MAXPARAMS];
+    sacapi_u32 batch;
+    sacapi_u32 rowset;
+    int rowset_calls;
+    sacapi_i32 fetched;
+    data_value4 columns[MAXCOLS];
+    int column_bound[MAXCOLS];
+    char *cell[MAXCOLS];
+    size_t cell_size[MAXCOLS];
+    size_t cell_len[MAXCOLS];
+    sacapi_bool cell_null[MAXCOLS];
+    char names[MAXCOLS][16];
+} stmt;
+
+static int max_version(void)
+{
+    const char *v = getenv("STUB_DBCAPI_VERSION");
+    return v ? atoi(v) : 4;
+}
+
+static void set_error(connection *c, sacapi_i32 code, const char *msg,
+                      const char *state)
+{
+    c->code = code;
+    snprintf(c->message, sizeof(c->message), "%s", msg);
+    snprintf(c->state, sizeof(c->state), "%s", state);
+}
+
+static void clear_error(connection *c)
+{
+    set_error(c, 0, "", "00000");
+}
+
+/* whether fetching row, counted from 0, raises a warning */
+static int warns(int row)
+{
+    const char *every = getenv("STUB_WARN_EVERY");
+    int n = every ? atoi(every) : 0;
+    return n > 0 && (row + 1) % n == 0;
+}
+
+/* the error left by a successful fetch of rows first to last */
+static void fetched_rows(connection *c, int first, int last)
+{
+    int row;
+    for (row = first; row <= last; row++)
+        if (warns(row)) {
+            set_error(c, 101, "Value truncated", "01004");
+            return;
+        }
+    clear_error(c);
+}
+
+/* Column type letters: i int, I nullable int, b bigint, u unsigned bigint,
+   h smallint, t bit, d double, n numeric, s varchar(64), S nullable
+   varchar(64), x binary(32), l long binary, L long varchar,
+   D timestamp. */
+static void column_spec(stmt *s, int c, int *type, int *native,
+                        size_t *max_size, int *nullable)
+{
+    *nullable = 0;
+    switch (s->cols[c]) {
+    case 'I': *nullable = 1; /* fall through */
+    case 'i': *type = A_VAL32; *native = DT_INT; *max_size = 4; break;
+    case 'b': *type = A_VAL64; *native = DT_BIGINT; *max_size = 8; break;
+    case 'u': *type = A_UVAL64; *native = DT_UNSBIGINT; *max_size = 8; break;
+    case 'h': *type = A_VAL16; *native = DT_SMALLINT; *max_size = 2; break;
+    case 't': *type = A_UVAL8; *native = DT_BIT; *max_size = 1; break;
+    case 'd': *type = A_DOUBLE; *native = DT_DOUBLE; *max_size = 8; break;
+    case 'n': *type = A_STRING; *native = DT_DECIMAL; *max_size = 32; break;
+    case 'S': *nullable = 1; /* fall through */
+    case 's': *type = A_STRING; *native = DT_VARCHAR; *max_size = 64; break;
+    case 'x': *type = A_BINARY; *native = DT_BINARY; *max_size = 32; break;
+    case 'l': *type = A_BINARY; *native = DT_LONGBINARY;
+              *max_size = 2147483647; break;
+    case 'L': *type = A_STRING; *native = DT_LONGVARCHAR;
+              *max_size = 2147483647; break;
+    case 'D': *type = A_STRING; *native = DT_TIMESTAMP; *max_size = 23; break;
+    default:  *type = A_VAL32; *native = DT_INT; *max_size = 4; break;
+    }
+}
+
+/* Produce the value of column c in row r into dst (of at least the size
+   returned by cell_capacity); returns the length, or -1 for NULL. */
+static long long produce(stmt *s, int r, int c, char *dst)
+{
+    int type, native, nullable;
+    size_t max_size, k;
+    column_spec(s, c, &type, &native, &max_size, &nullable);
+    if (s->kind == K_CHARSET) {
+        memcpy(dst, "UTF-8", 5);
+        return 5;
+    }
+    if (s->kind == K_STATS) {
+        memcpy(dst, &s->stats[c], 8);
+        return 8;
+    }
+    if (nullable && r % 5 == 3)
+        return -1;
+    switch (s->cols[c]) {
+    case 'i': case 'I': { int v = r * 31 + c; memcpy(dst, &v, 4); return 4; }
+    case 'b': { long long v = (long long)r * 1000003; memcpy(dst, &v, 8); return 8; }
+    case 'u': { unsigned long long v = (unsigned long long)r << 33; memcpy(dst, &v, 8); return 8; }
+    case 'h': { short v = (short)(r % 30000 - 15000); memcpy(dst, &v, 2); return 2; }
+    case 't': { unsigned char v = (unsigned char)(r & 1); memcpy(dst, &v, 1); return 1; }
+    case 'd': { double v = r * 0.5; memcpy(dst, &v, 8); return 8; }
+    case 'n': return sprintf(dst, "%d.%02d", r, r % 100);
+    case 's': case 'S': return sprintf(dst, "row %d col %d", r, c);
+    case 'x':
+        for (k = 0; k < 16; k++)
+            dst[k] = (char)((r + c + k) & 0xff);
+        return 16;
+    case 'l':
+        for (k = 0; k < s->longsize; k++)
+            dst[k] = (char)((r + k) & 0xff);
+        return (long long)s->longsize;
+    case 'L':
+        for (k = 0; k < s->longsize; k++)
+            dst[k] = (char)('a' + (r + k) % 26);
+        return (long long)s->longsize;
+    case 'D':
+        return sprintf(dst, "2024-01-%02d 10:%02d:%02d.000",
+                       r % 28 + 1, r % 60, c % 60);
+    }
+    return -1;
+}
+
+static size_t cell_capacity(stmt *s, int c)
+{
+    if (s->kind == K_SYNTH && (s->cols[c] == 'l' || s->cols[c] == 'L'))
+        return s->longsize + 1;
+    return 65;
+}
+
+EXPORT sacapi_bool sqlany_init(const char *app, sacapi_u32 version,
+                               sacapi_u32 *max)
+{
+    (void)app;
+    if (max)
+        *max = (sacapi_u32)max_version();
+    return (int)version <= max_version();
+}
+
+EXPORT void sqlany_fini(void) {}
+
+EXPORT context *sqlany_init_ex(const char *app, sacapi_u32 version,
+                               sacapi_u32 *max)
+{
+    context *ctx;
+    (void)app;
+    if (max)
+        *max = (sacapi_u32)max_version();
+    if ((int)version > max_version() || version < 2)
+        return NULL;
+    ctx = calloc(1, sizeof(*ctx));
+    ctx->version = (int)version;
+    return ctx;
+}
+
+EXPORT void sqlany_fini_ex(context *ctx) { free(ctx); }
+
+static connection *new_connection(int version)
+{
+    connection *c = calloc(1, sizeof(*c));
+    c->version = version;
+    clear_error(c);
+    return c;
+}
+
+EXPORT connection *sqlany_new_connection(void) { return new_connection(1); }
+
+EXPORT connection *sqlany_new_connection_ex(context *ctx)
+{
+    return new_connection(ctx->version);
+}
+
+EXPORT void sqlany_free_connection(connection *c) { free(c); }
+
+EXPORT sacapi_bool sqlany_connect(connection *c, const char *params)
+{
+    if (params && strstr(params, "pwd=wrong")) {
+        set_error(c, -103, "Invalid user ID or password", "28000");
+        return 0;
+    }
+    clear_error(c);
+    c->connected = 1;
+    return 1;
+}
+
+EXPORT sacapi_bool sqlany_disconnect(connection *c)
+{
+    c->connected = 0;
+    return 1;
+}
+
+EXPORT void sqlany_cancel(connection *c) { c->cancelled = 1; }
+
+EXPORT sacapi_i32 sqlany_error(connection *c, char *buf, size_t size)
+{
+    if (buf && size) {
+        strncpy(buf, c->message, size - 1);
+        buf[size - 1] = '\0';
+    }
+    return c->code;
+}
+
+EXPORT size_t sqlany_sqlstate(connection *c, char *buf, size_t size)
+{
+    if (buf && size) {
+        strncpy(buf, c->state, size - 1);
+        buf[size - 1] = '\0';
+    }
+    return strlen(c->state) + 1;
+}
+
+EXPORT void sqlany_clear_error(connection *c) { clear_error(c); }
+
+EXPORT sacapi_bool sqlany_commit(connection *c) { clear_error(c); return 1; }
+
+EXPORT sacapi_bool sqlany_rollback(connection *c) { clear_error(c); return 1; }
+
+EXPORT sacapi_bool sqlany_client_version(char *buf, size_t size)
+{
+    snprintf(buf, size, "17.0.0.0000 (stub)");
+    return 1;
+}
+
+EXPORT sacapi_bool sqlany_client_version_ex(context *ctx, char *buf,
+                                            size_t size)
+{
+    (void)ctx;
+    return sqlany_client_version(buf, size);
+}
+
+EXPORT sacapi_bool sqlany_execute_immediate(connection *c, const char *sql)
+{
+    (void)sql;
+    clear_error(c);
+    return 1;
+}
+
+static int starts_with(const char *s, const char *prefix)
+{
+    return strncmp(s, prefix, strlen(prefix)) == 0;
+}
+
+EXPORT stmt *sqlany_prepare(connection *c, const char *sql)
+{
+    stmt *s;
+    const char *p;
+    int i;
+    c->prepares++;
+    if (starts_with(sql, "select SYNTH "))
+        sql += 7;
+    if (starts_with(sql, "BAD")) {
+        set_error(c, -131, "Syntax error near 'BAD'", "42W04");
+        return NULL;
+    }
+    clear_error(c);
+    s = calloc(1, sizeof(*s));
+    s->conn = c;
+    s->row = -1;
+    s->batch = 1;
+    s->rowset = 1;
+    if (starts_with(sql, "SYNTH STATS")) {
+        s->kind = K_STATS;
+        s->nrows = 1;
+        s->ncols = 6;
+        strcpy(s->cols, "bbbbbb");
+    } else if (starts_with(sql, "SYNTH ")) {
+        unsigned long longsize = 65536;
+        s->kind = K_SYNTH;
+        if (sscanf(sql + 6, "%d %64s %lu %d", &s->nrows, s->cols, &longsize,
+                   &s->sleep_ms) < 2) {
+            set_error(c, -131, "Syntax error in SYNTH", "42W04");
+            free(s);
+            return NULL;
+        }
+        s->ncols = (int)strlen(s->cols);
+        s->longsize = longsize;
+    } else if (strstr(sql, "connection_property('CharSet')")) {
+        s->kind = K_CHARSET;
+        s->nrows = 1;
+        s->ncols = 1;
+        strcpy(s->cols, "s");
+    } else if (starts_with(sql, "SLEEP ")) {
+        s->kind = K_SLEEP;
+        s->sleep_ms = atoi(sql + 6);
+    } else {
+        s->kind = K_OTHER;
+    }
+    for (p = sql; *p; p++)
+        if (*p == '?')
+            s->nparams++;
+    for (i = 0; i < s->ncols; i++) {
+        s->cell_size[i] = cell_capacity(s, i);
+        s->cell[i] = malloc(s->cell_size[i]);
+        snprintf(s->names[i], sizeof(s->names[i]), "c%d", i);
+    }
+    return s;
+}
+
+EXPORT void sqlany_free_stmt(stmt *s)
+{
+    int i;
+    if (!s)
+        return;
+    for (i = 0; i < s->ncols; i++)
+        free(s->cell[i]);
+    free(s);
+}
+
+EXPORT sacapi_i32 sqlany_num_params(stmt *s) { return s->nparams; }
+
+EXPORT sacapi_bool sqlany_describe_bind_param(stmt *s, sacapi_u32 index,
+                                              void *param)
+{
+    if ((int)index >= s->nparams)
+        return 0;
+    if (s->conn->version >= 4) {
+        bind_param4 *p = param;
+        memset(p, 0, sizeof(*p));
+        p->direction = 1;
+    } else {
+        bind_param2 *p = param;
+        memset(p, 0, sizeof(*p));
+        p->direction = 1;
+    }
+    return 1;
+}
+
+EXPORT sacapi_bool sqlany_bind_param(stmt *s, sacapi_u32 index, void *param)
+{
+    if ((int)index >= s->nparams)
+        return 0;
+    if (s->conn->version >= 4) {
+        s->params[index] = ((bind_param4 *)param)->value;
+    } else {
+        data_value2 *v = &((bind_param2 *)param)->value;
+        memset(&s->params[index], 0, sizeof(s->params[index]));
+        memcpy(&s->params[index], v, sizeof(*v));
+    }
+    s->bound[index] = 1;
+    return 1;
+}
+
+EXPORT sacapi_bool sqlany_send_param_data(stmt *s, sacapi_u32 index,
+                                          char *buffer, size_t size)
+{
+    (void)buffer;
+    if ((int)index >= s->nparams)
+        return 0;
+    s->streamed[index] += (long long)size;
+    return 1;
+}
+
+EXPORT sacapi_bool sqlany_reset(stmt *s)
+{
+    s->row = -1;
+    s->executed = 0;
+    s->fetched = 0;
+    memset(s->streamed, 0, sizeof(s->streamed));
+    return 1;
+}
+
+EXPORT sacapi_bool sqlany_get_bind_param_info(stmt *s, sacapi_u32 index,
+                                              void *info)
+{
+    (void)s; (void)index; (void)info;
+    return 0;
+}
+
+static long long int_param(int type, const char *p)
+{
+    switch (type) {
+    case A_VAL64: { long long v; memcpy(&v, p, 8); return v; }
+    case A_UVAL64: { unsigned long long v; memcpy(&v, p, 8); return (long long)v; }
+    case A_VAL32: { int v; memcpy(&v, p, 4); return v; }
+    case A_UVAL32: { unsigned v; memcpy(&v, p, 4); return v; }
+    case A_VAL16: { short v; memcpy(&v, p, 2); return v; }
+    case A_UVAL16: { unsigned short v; memcpy(&v, p, 2); return v; }
+    case A_VAL8: return (signed char)*p;
+    case A_UVAL8: return (unsigned char)*p;
+    }
+    return 0;
+}
+
+static void consume_params(stmt *s, int row)
+{
+    connection *c = s->conn;
+    int i;
+    for (i = 0; i < s->nparams; i++) {
+        data_value4 *v = &s->params[i];
+        const char *p;
+        size_t len;
+        if (!s->bound[i])
+            continue;
+        c->param_bytes += s->streamed[i];
+        if (v->is_null && v->is_null[row])
+            continue;
+        p = v->buffer + (size_t)row * v->buffer_size;
+        len = v->length ? v->length[row] : v->buffer_size;
+        if (v->type == A_BINARY || v->type == A_STRING)
+            c->param_bytes += (long long)len;
+        else if (v->type == A_DOUBLE) {
+            double d;
+            memcpy(&d, p, 8);
+            c->int_sum += (long long)d;
+        } else
+            c->int_sum += int_param(v->type, p);
+    }
+    c->inserted++;
+}
+
+static int sleep_cancellable(connection *c, int ms)
+{
+    struct timespec ts = {0, 1000000};
+    for (; ms > 0; ms--) {
+        if (c->cancelled)
+            return 0;
+        nanosleep(&ts, NULL);
+    }
+    return !c->cancelled;
+}
+
+EXPORT sacapi_bool sqlany_execute(stmt *s)
+{
+    connection *c = s->conn;
+    sacapi_u32 r;
+    c->executes++;
+    c->cancelled = 0;
+    clear_error(c);
+    s->row = -1;
+    s->fetched = 0;
+    if (s->kind == K_SLEEP && !sleep_cancellable(c, s->sleep_ms)) {
+        c->cancelled = 0;
+        set_error(c, -299, "Statement interrupted by user", "57014");
+        return 0;
+    }
+    if (s->kind == K_STATS) {
+        s->stats[0] = c->inserted;
+        s->stats[1] = c->int_sum;
+        s->stats[2] = c->param_bytes;
+        s->stats[3] = c->streamed;
+        s->stats[4] = c->prepares;
+        s->stats[5] = c->executes;
+    }
+    if (s->nparams > 0) {
+        for (r = 0; r < s->batch; r++)
+            consume_params(s, (int)r);
+        for (r = 0; r < (sacapi_u32)s->nparams; r++) {
+            c->streamed += s->streamed[r];
+            s->streamed[r] = 0;
+        }
+    }
+    s->executed = 1;
+    return 1;
+}
+
+EXPORT stmt *sqlany_execute_direct(connection *c, const char *sql)
+{
+    stmt *s = sqlany_prepare(c, sql);
+    if (s && !sqlany_execute(s)) {
+        sqlany_free_stmt(s);
+        return NULL;
+    }
+    return s;
+}
+
+static int has_result(stmt *s)
+{
+    return s->kind == K_SYNTH || s->kind == K_STATS || s->kind == K_CHARSET;
+}
+
+static void load_row(stmt *s)
+{
+    int c;
+    for (c = 0; c < s->ncols; c++) {
+        long long len = produce(s, s->row, c, s->cell[c]);
+        s->cell_null[c] = len < 0;
+        s->cell_len[c] = len < 0 ? 0 : (size_t)len;
+        if (len >= 0 && (size_t)len < s->cell_size[c])
+            s->cell[c][len] = '\0';
+    }
+}
+
+static int any_bound(stmt *s)
+{
+    int c;
+    for (c = 0; c < s->ncols; c++)
+        if (s->column_bound[c])
+            return 1;
+    return 0;
+}
+
+static void fetch_latency(void)
+{
+    static long us = -1;
+    if (us < 0) {
+        const char *v = getenv("STUB_FETCH_LATENCY_US");
+        us = v ? atol(v) : 0;
+    }
+    if (us > 0) {
+        struct timespec ts;
+        ts.tv_sec = us / 1000000;
+        ts.tv_nsec = (us % 1000000) * 1000;
+        nanosleep(&ts, NULL);
+    }
+}
+
+EXPORT sacapi_bool sqlany_fetch_next(stmt *s)
+{
+    connection *c = s->conn;
+    fetch_latency();
+    if (!s->executed || !has_result(s)) {
+        set_error(c, -213, "Cursor not open", "24501");
+        return 0;
+    }
+    if (s->kind == K_SYNTH && s->sleep_ms > 0 && s->row < 0 &&
+            !sleep_cancellable(c, s->sleep_ms)) {
+        c->cancelled = 0;
+        set_error(c, -299, "Statement interrupted by user", "57014");
+        return 0;
+    }
+    if (any_bound(s)) {
+        sacapi_u32 k;
+        s->fetched = 0;
+        for (k = 0; k < s->rowset && s->row + 1 < s->nrows; k++) {
+            int col;
+            s->row++;
+            load_row(s);
+            for (col = 0; col < s->ncols; col++) {
+                data_value4 *b = &s->columns[col];
+                size_t n;
+                if (!s->column_bound[col])
+                    continue;
+                if (b->is_null)
+                    b->is_null[k] = s->cell_null[col];
+                n = s->cell_len[col];
+                if (b->length)
+                    b->length[k] = n;
+                if (n > b->buffer_size)
+                    n = b->buffer_size;
+                memcpy(b->buffer + k * b->buffer_size, s->cell[col], n);
+            }
+            s->fetched++;
+        }
+        if (s->fetched == 0) {
+            set_error(c, 100, "Row not found", "02000");
+            return 0;
+        }
+        fetched_rows(c, s->row - s->fetched + 1, s->row);
+        return 1;
+    }
+    if (s->row + 1 >= s->nrows) {
+        s->row = s->nrows;
+        set_error(c, 100, "Row not found", "02000");
+        return 0;
+    }
+    s->row++;
+    load_row(s);
+    s->fetched = 1;
+    fetched_rows(c, s->row, s->row);
+    return 1;
+}
+
+EXPORT sacapi_bool sqlany_fetch_absolute(stmt *s, sacapi_i32 row)
+{
+    if (row < 1 || row > s->nrows) {
+        set_error(s->conn, 100, "Row not found", "02000");
+        return 0;
+    }
+    s->row = row - 2;
+    return sqlany_fetch_next(s);
+}
+
+EXPORT sacapi_bool sqlany_get_next_result(stmt *s)
+{
+    (void)s;
+    return 0;
+}
+
+EXPORT sacapi_i32 sqlany_affected_rows(stmt *s)
+{
+    return s->nparams > 0 ? (sacapi_i32)s->batch : (has_result(s) ? -1 : 1);
+}
+
+EXPORT sacapi_i32 sqlany_num_cols(stmt *s)
+{
+    return has_result(s) ? s->ncols : 0;
+}
+
+EXPORT sacapi_i32 sqlany_num_rows(stmt *s)
+{
+    return has_result(s) ? s->nrows : -1;
+}
+
+EXPORT sacapi_bool sqlany_get_column(stmt *s, sacapi_u32 index, void *value)
+{
+    data_value2 *v = value;
+    int type, native, nullable;
+    size_t max_size;
+    if ((int)index >= s->ncols || s->row < 0 || s->row >= s->nrows) {
+        set_error(s->conn, -132, "Invalid column index", "07009");
+        return 0;
+    }
+    column_spec(s, (int)index, &type, &native, &max_size, &nullable);
+    v->buffer = s->cell[index];
+    v->buffer_size = s->cell_size[index];
+    v->length = &s->cell_len[index];
+    v->type = type;
+    v->is_null = &s->cell_null[index];
+    return 1;
+}
+
+EXPORT sacapi_i32 sqlany_get_data(stmt *s, sacapi_u32 index, size_t offset,
+                                  void *buffer, size_t size)
+{
+    size_t n;
+    if ((int)index >= s->ncols || s->row < 0 || s->row >= s->nrows) {
+        set_error(s->conn, -132, "Invalid column index", "07009");
+        return -1;
+    }
+    if (offset >= s->cell_len[index])
+        return 0;
+    n = s->cell_len[index] - offset;
+    if (n > size)
+        n = size;
+    memcpy(buffer, s->cell[index] + offset, n);
+    return (sacapi_i32)n;
+}
+
+EXPORT sacapi_bool sqlany_get_data_info(stmt *s, sacapi_u32 index,
+                                        data_info *info)
+{
+    int type, native, nullable;
+    size_t max_size;
+    if ((int)index >= s->ncols || s->row < 0 || s->row >= s->nrows)
+        return 0;
+    column_spec(s, (int)index, &type, &native, &max_size, &nullable);
+    info->index = (int)index;
+    info->type = type;
+    info->is_null = s->cell_null[index];
+    info->data_size = s->cell_len[index];
+    return 1;
+}
+
+EXPORT sacapi_bool sqlany_get_column_info(stmt *s, sacapi_u32 index,
+                                          void *info)
+{
+    column_info2 *ci = info;
+    int type, native, nullable;
+    size_t max_size;
+    if ((int)index >= s->ncols)
+        return 0;
+    column_spec(s, (int)index, &type, &native, &max_size, &nullable);
+    ci->name = s->names[index];
+    ci->type = type;
+    ci->native_type = native;
+    ci->precision = 0;
+    ci->scale = 0;
+    ci->max_size = max_size;
+    ci->nullable = nullable;
+    if (s->conn->version >= 4) {
+        column_info4 *ci4 = info;
+        ci4->table_name = "synth";
+        ci4->owner_name = "stub";
+        ci4->is_bound = s->column_bound[index];
+        ci4->binding = s->columns[index];
+    }
+    return 1;
+}
+
+/* API version 4: wide fetches and inserts. */
+
+EXPORT sacapi_bool sqlany_set_batch_size(stmt *s, sacapi_u32 rows)
+{
+    if (s->conn->version < 4 || rows < 1)
+        return 0;
+    s->batch = rows;
+    return 1;
+}
+
+EXPORT sacapi_u32 sqlany_get_batch_size(stmt *s) { return s->batch; }
+
+EXPORT sacapi_bool sqlany_set_param_bind_type(stmt *s, size_t row_size)
+{
+    return s->conn->version >= 4 && row_size == 0;
+}
+
+EXPORT sacapi_bool sqlany_set_rowset_size(stmt *s, sacapi_u32 rows)
+{
+    const char *fail = getenv("STUB_ROWSET_SIZE_FAILS");
+    if (s->conn->version < 4 || rows < 1)
+        return 0;
+    if (rows > 1 && fail && ++s->rowset_calls == atoi(fail))
+        return 0;
+    s->rowset = rows;
+    return 1;
+}
+
+EXPORT sacapi_u32 sqlany_get_rowset_size(stmt *s) { return s->rowset; }
+
+EXPORT sacapi_bool sqlany_set_column_bind_type(stmt *s, sacapi_u32 row_size)
+{
+    return s->conn->version >= 4 && row_size == 0;
+}
+
+EXPORT sacapi_bool sqlany_bind_column(stmt *s, sacapi_u32 index,
+                                      data_value4 *value)
+{
+    if (s->conn->version < 4 || (int)index >= s->ncols)
+        return 0;
+    s->columns[index] = *value;
+    s->column_bound[index] = 1;
+    return 1;
+}
+
+EXPORT sacapi_bool sqlany_clear_column_bindings(stmt *s)
+{
+    memset(s->column_bound, 0, sizeof(s->column_bound));
+    return 1;
+}
+
+EXPORT sacapi_i32 sqlany_fetched_rows(stmt *s) { return s->fetched; }
+
+EXPORT sacapi_bool sqlany_reset_param_data(stmt *s)
+{
+    memset(s->streamed, 0, sizeof(s->streamed));
+    return 1;
+}
+
+EXPORT size_t sqlany_error_length(connection *c)
+{
+    return strlen(c->message) + 1;
+}
@@ -0,0 +1,480 @@
+#!/usr/bin/env python
+# ***************************************************************************
+# Copyright (c) 2024 SAP SE or an SAP affiliate company. All rights reserved.
+# ***************************************************************************
+# This sample code is provided AS IS, without warranty or liability
+# of any kind.
+#
+# You may use, reproduce, modify and distribute this sample code
+# without limitation, on the condition that you retain the foregoing
+# copyright notice and disclaimer as to the original code.
+# ***************************************************************************
+"""Tests of sqlanydb that need no database server.
+
+The driver is run against stub_dbcapi.c, built as benchmark.py builds it,
+so these tests check the driver's own behaviour: fetching, timeouts, the
+result cache and the connection pool.  They are skipped if the stub
+cannot be built.
+
+    python test_stub.py
+"""
+import gc
+import os
+import struct
+import subprocess
+import sys
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(1, HERE)
+import benchmark
+import sqlanydb
+
+def setUpModule():
+    try:
+        library = benchmark.build_stub()
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise unittest.SkipTest('cannot build the stub dbcapi library: %s' %
+                                (e,))
+    os.environ['SQLANY_API_DLL'] = library
+
+def connect(**kwargs):
+    return sqlanydb.connect(uid='dba', pwd='sql', **kwargs)
+
+# a result set of every column type the stub makes up, with NULLs
+COLUMNS = 'iIbdsSxntDhun'
+
+class StubTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.con = connect()
+
+    def tearDown(self):
+        if self.con.c:
+            self.con.close()
+
+
+class test_fetch(StubTestCase):
+
+    def fetch(self, rowset_size, background=False):
+        cur = self.con.cursor()
+        cur.rowset_size = rowset_size
+        cur.background_prefetch = background
+        cur.execute('SYNTH 3000 %s' % COLUMNS)
+        rows = [cur.fetchone()] + cur.fetchmany(10) + [next(cur)]
+        rows += cur.fetchall()
+        cur.close()
+        return rows
+
+    def test_wide_and_narrow_fetches_agree(self):
+        narrow = self.fetch(1)
+        self.assertEqual(len(narrow), 3000)
+        self.assertEqual(self.fetch(sqlanydb.ROWSET_SIZE), narrow)
+        self.assertEqual(self.fetch(7), narrow)
+        self.assertEqual(self.fetch(7, background=True), narrow)
+        self.assertEqual(self.fetch(1, background=True), narrow)
+
+    def test_binary_views(self):
+        cur = self.con.cursor()
+        cur.execute('SYNTH 3 ix')
+        rows = cur.fetchall()
+        cur.binary_views = True
+        cur.execute('SYNTH 3 ix')
+        for row in rows:
+            view = cur.fetchone()[1]
+            self.assertTrue(isinstance(view, memoryview))
+            self.assertEqual(view.tobytes(), row[1])
+            if hasattr(view, 'toreadonly'):
+                self.assertTrue(view.readonly)
+
+    def test_second_rowset_fails(self):
+        # the arrays for background prefetch cannot be bound, so the
+        # statement falls back to fetching a row at a time
+        narrow = self.fetch(1)
+        os.environ['STUB_ROWSET_SIZE_FAILS'] = '2'
+        try:
+            cur = self.con.cursor()
+            cur.background_prefetch = True
+            cur.execute('SYNTH 3000 %s' % COLUMNS)
+            self.assertEqual(cur.rowset, None)
+            self.assertEqual(cur.fetchall(), narrow)
+        finally:
+            del os.environ['STUB_ROWSET_SIZE_FAILS']
+
+    def test_setoutputsize_hint(self):
+        cur = self.con.cursor()
+        cur.setoutputsize(1000)
+        cur.execute('SYNTH 2 il 2500')
+        rows = cur.fetchall()
+        self.assertEqual([len(row[1]) for row in rows], [2500, 2500])
+        self.assertTrue(isinstance(rows[0][1], bytes))
+        cur.stream_long_columns = True
+        cur.execute('SYNTH 2 il 2500')
+        reader = cur.fetchone()[1]
+        self.assertEqual([len(c) for c in reader.chunks()], [1000, 1000, 500])
+
+    def test_column_reader_needs_rows_one_at_a_time(self):
+        os.environ['STUB_DBCAPI_VERSION'] = '2'
+        try:
+            con = connect()
+        finally:
+            del os.environ['STUB_DBCAPI_VERSION']
+        try:
+            cur = con.cursor()
+            for rows in (2000, 10):
+                cur.execute('SYNTH %d is' % rows)
+                self.assertEqual(cur.fetchone()[0], 0)
+                self.assertRaises(sqlanydb.ProgrammingError,
+                                  cur.column_reader, 1)
+            cur.rowset_size = 1
+            cur.execute('SYNTH 2000 is')
+            row = cur.fetchone()
+            self.assertEqual(cur.column_reader(1).read(), row[1].encode())
+        finally:
+            con.close()
+
+    def test_arrow_string_buffers(self):
+        buffers, null_count = sqlanydb.arrow_buffers(
+            b'u', None, [['ab', None], [b'c', '']])
+        validity, offsets, data = buffers
+        self.assertEqual(null_count, 1)
+        self.assertEqual(struct.unpack('=5i', offsets), (0, 2, 2, 3, 3))
+        self.assertEqual(data, b'abc')
+
+    def test_collect_warnings(self):
+        truncated = (sqlanydb.Warning, b'Value truncated')
+        end = (sqlanydb.Warning, b'Row not found')
+        os.environ['STUB_WARN_EVERY'] = '10'
+        try:
+            cur = self.con.cursor()
+            cur.rowset_size = 1
+            cur.execute('SYNTH 35 i')
+            self.assertEqual(len(cur.fetchall()), 35)
+            self.assertEqual(cur.messages, [end])
+            cur.collect_warnings = True
+            cur.execute('SYNTH 35 i')
+            self.assertEqual(len(cur.fetchall()), 35)
+            self.assertEqual(cur.messages, [truncated] * 3 + [end])
+            if self.con.api_version >= sqlanydb.API_VERSION_WIDE:
+                # a wide fetch is checked once per rowset
+                cur.rowset_size = 16
+                cur.collect_warnings = False
+                cur.execute('SYNTH 35 i')
+                self.assertEqual(len(cur.fetchall()), 35)
+                self.assertEqual(cur.messages, [truncated] * 2 + [end])
+        finally:
+            del os.environ['STUB_WARN_EVERY']
+        cur.execute('SYNTH 3 i')
+        self.assertEqual(cur.messages, [])
+        self.assertEqual(len(cur.fetchall()), 3)
+        self.assertEqual(cur.messages, [end])
+
+
+class test_parameters(StubTestCase):
+
+    def stats(self, cur):
+        cur.execute('SYNTH STATS')
+        return cur.fetchone()[:3]
+
+    def test_value_that_does_not_fit_inputsize(self):
+        cur = self.con.cursor()
+        cur.setinputsizes((int,))
+        cur.execute('insert into t values (?)', ('abc',))
+        self.assertEqual(self.stats(cur), (1, 0, 3))
+        cur.setinputsizes((int,))
+        cur.execute('insert into t values (?)', (1 << 70,))
+        self.assertEqual(self.stats(cur), (2, 0, 3 + len(str(1 << 70))))
+        cur.setinputsizes((int,))
+        cur.execute('insert into t values (?)', (5,))
+        self.assertEqual(self.stats(cur), (3, 5, 3 + len(str(1 << 70))))
+
+
+class test_query_timeout(StubTestCase):
+
+    def test_timeout_cancels_statement(self):
+        cur = self.con.cursor()
+        start = time.time()
+        self.assertRaises(sqlanydb.QueryTimeoutError, cur.execute,
+                          'SLEEP 5000', timeout=0.2)
+        self.assertTrue(time.time() - start < 2)
+        # the connection is still usable, and a statement that finishes
+        # in time is not cancelled
+        cur.execute('SLEEP 10', timeout=5)
+        cur.execute('SYNTH 3 i')
+        self.assertEqual(len(cur.fetchall()), 3)
+
+    def test_timeout_covers_first_fetch(self):
+        cur = self.con.cursor()
+        for background in (False, True):
+            cur.background_prefetch = background
+            start = time.time()
+            self.assertRaises(sqlanydb.QueryTimeoutError, cur.execute,
+                              'SYNTH 3 i 0 5000', timeout=0.2)
+            self.assertTrue(time.time() - start < 2)
+            cur.execute('SYNTH 3000 i 0 10', timeout=5)
+            self.assertEqual(len(cur.fetchall()), 3000)
+
+    def test_connection_query_timeout(self):
+        con = connect(query_timeout=0.2)
+        try:
+            cur = con.cursor()
+            self.assertRaises(sqlanydb.QueryTimeoutError, cur.execute,
+                              'SLEEP 5000')
+            cur.execute('SLEEP 10', timeout=5)
+        finally:
+            con.close()
+
+
+class test_async(unittest.TestCase):
+
+    def test_cursor_does_not_wait_for_statement(self):
+        try:
+            import asyncio
+        except ImportError:
+            self.skipTest('asyncio is not available')
+
+        async def run():
+            con = await sqlanydb.connect_async(uid='dba', pwd='sql')
+            cur = con.cursor()
+            sleeping = asyncio.ensure_future(cur.execute('SLEEP 1000'))
+            await asyncio.sleep(0.1)
+            start = time.time()
+            other = con.cursor()
+            elapsed = time.time() - start
+            await sleeping
+            await other.execute('SYNTH 3 i')
+            rows = await other.fetchall()
+            await con.close()
+            return elapsed, rows
+
+        loop = asyncio.new_event_loop()
+        try:
+            elapsed, rows = loop.run_until_complete(run())
+        finally:
+            loop.close()
+        self.assertTrue(elapsed < 0.5)
+        self.assertEqual(len(rows), 3)
+
+
+class test_result_cache(StubTestCase):
+
+    query = 'select SYNTH 5 iIs from t where k = ?'
+
+    def setUp(self):
+        self.con = connect(result_cache_size=1 << 20, result_cache_ttl=60)
+        self.cache = self.con.result_cache
+        self.cur = self.con.cursor()
+
+    def run_query(self, k=1, **kwargs):
+        self.cur.execute(self.query, (k,), **kwargs)
+        return self.cur.fetchall()
+
+    def test_hit(self):
+        rows = self.run_query()
+        description = self.cur.description
+        self.cur.execute('SELECT  SYNTH 5 iIs  FROM t WHERE k = ? -- again',
+                         (1,))
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cur.fetchall(), rows)
+        self.assertEqual(self.cur.description, description)
+        self.assertEqual(self.cur.fetchone(), None)
+        self.run_query(2)
+        self.run_query(1.0)
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(len(self.cache), 3)
+
+    def test_write_invalidates_until_transaction_ends(self):
+        self.run_query()
+        self.cur.execute('select SYNTH 3 i from u')
+        self.cur.execute('insert into T values (?)', (1,))
+        self.assertEqual(len(self.cache), 1)
+        self.run_query()
+        self.assertEqual(len(self.cache), 1)
+        self.con.commit()
+        self.run_query()
+        self.run_query()
+        self.assertEqual((len(self.cache), self.cache.hits), (2, 1))
+        self.cur.execute('update t set a = 1')
+        self.con.rollback()
+        self.run_query()
+        self.assertEqual(len(self.cache), 2)
+
+    def test_unknown_write_invalidates_everything(self):
+        self.run_query()
+        self.cur.callproc('p')
+        self.assertEqual(len(self.cache), 0)
+        self.run_query()
+        self.assertEqual(len(self.cache), 0)
+        self.con.commit()
+        self.run_query()
+        self.assertEqual(len(self.cache), 1)
+
+    def test_batch_is_not_cached(self):
+        self.run_query()
+        self.cur.execute("select SYNTH 3 i from t where s = ';'")
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(sqlanydb.parse_statement('select * from t;')[1],
+                         'read')
+        self.assertEqual(sqlanydb.parse_statement(
+            'select * from t; delete from u')[1:],
+            ('write', frozenset(['t', 'u', sqlanydb.ALL_TABLES])))
+        self.cur.execute('select SYNTH 3 i from u; delete from t')
+        self.assertEqual(len(self.cache), 0)
+        self.run_query()
+        self.assertEqual(len(self.cache), 0)
+
+    def test_volatile_queries_are_not_cached(self):
+        for query in ['select SYNTH 3 i from t where a = rand()',
+                      'select SYNTH 3 i from t where a = NewID ( )',
+                      'select SYNTH 3 i from t where d < current timestamp',
+                      'select SYNTH 3 i from t where d < Today(*)',
+                      'select SYNTH 3 i from t where a = s.nextval',
+                      'select SYNTH 3 i from t where a = @@identity']:
+            self.cur.execute(query)
+            self.cur.execute(query)
+            self.assertEqual(len(self.cur.fetchall()), 3)
+        self.assertEqual((len(self.cache), self.cache.hits), (0, 0))
+        # a column that shares a name with a function is not a call
+        self.cur.execute("select SYNTH 3 i from t where rand = 'now()'")
+        self.assertEqual(len(self.cache), 1)
+        # nor is a subquery, but selecting from a procedure may write
+        for query in ['select * from sa_rowgenerator(1, 10)',
+                      'select * from t join DBA.my_proc (?) p on 1 = 1',
+                      'select * from t, my_proc(?)']:
+            self.assertEqual(sqlanydb.parse_statement(query)[1], 'write')
+        self.assertEqual(sqlanydb.parse_statement(
+            'select * from (select * from t) s where a in (1)')[1:],
+            ('read', frozenset(['t'])))
+        self.cur.execute('select SYNTH 3 i from my_proc(?)', (1,))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_invalidate_and_ttl(self):
+        self.run_query()
+        self.cache.invalidate('T')
+        self.assertEqual(len(self.cache), 0)
+        self.run_query(cache_ttl=0)
+        self.assertEqual(len(self.cache), 0)
+        self.run_query(cache_ttl=0.05)
+        time.sleep(0.1)
+        misses = self.cache.misses
+        self.run_query()
+        self.assertEqual(self.cache.misses, misses + 1)
+
+    def test_budget(self):
+        con = connect(result_cache_size=2000)
+        try:
+            cur = con.cursor()
+            cur.execute('select SYNTH 1000 iIs from t')
+            self.assertEqual(len(cur.fetchall()), 1000)
+            self.assertEqual(len(con.result_cache), 0)
+            for k in range(20):
+                cur.execute(self.query, (k,))
+            self.assertTrue(con.result_cache.bytes <= 2000)
+            self.assertTrue(con.result_cache.evictions > 0)
+        finally:
+            con.close()
+
+
+class test_connect(unittest.TestCase):
+
+    def test_unknown_char_set(self):
+        # the connection that failed is not left to be closed when it
+        # is collected
+        errors = []
+        hook = getattr(sys, 'unraisablehook', None)
+        sys.unraisablehook = errors.append
+        try:
+            self.assertRaises(LookupError, connect, char_set='no-such-codec')
+            gc.collect()
+        finally:
+            sys.unraisablehook = hook
+        self.assertEqual(errors, [])
+
+    def test_char_sets_are_not_keyed_on_passwords(self):
+        sqlanydb.Connection.char_sets.clear()
+        for k in range(sqlanydb.CHAR_SETS_SIZE + 1):
+            connect(dbn='db%d' % k).close()
+        keys = [dict(key) for key in sqlanydb.Connection.char_sets]
+        self.assertEqual(len(keys), sqlanydb.CHAR_SETS_SIZE)
+        self.assertEqual(keys[0]['dbn'], 'db1')
+        for key in keys:
+            self.assertEqual(key['uid'], 'dba')
+            self.assertTrue('pwd' not in key)
+
+
+class test_pool(unittest.TestCase):
+
+    def test_release(self):
+        pool = sqlanydb.ConnectionPool(max_size=1, timeout=0.1,
+                                       uid='dba', pwd='sql')
+        try:
+            con = pool.acquire()
+            raw = con.connection
+            cur = con.cursor()
+            cur.execute('SYNTH 3 i')
+            self.assertRaises(sqlanydb.PoolTimeoutError, pool.acquire)
+            con.close()
+            self.assertEqual(cur.parent, None)
+            self.assertEqual(pool.stats()['idle'], 1)
+            con = pool.acquire()
+            self.assertTrue(con.connection is raw)
+            self.assertEqual(len(raw.cursors), 0)
+            con.close()
+            self.assertEqual(pool.stats()['created'], 1)
+        finally:
+            pool.close()
+
+    def test_release_resets_connection(self):
+        pool = sqlanydb.ConnectionPool(max_size=1, uid='dba', pwd='sql',
+                                       query_timeout=5)
+        try:
+            with pool.acquire() as cur:
+                raw = cur.parent
+                self.assertTrue(isinstance(cur, sqlanydb.Cursor))
+                raw.add_hook('on_execute', lambda info: None)
+                raw.query_timeout = 0.1
+                raw.result_cache = sqlanydb.ResultCache(1 << 20)
+                cur.execute('SYNTH 3 i')
+            con = pool.acquire()
+            self.assertTrue(con.connection is raw)
+            self.assertEqual(raw.hooks, {})
+            self.assertEqual(raw.query_timeout, 5)
+            self.assertEqual(raw.result_cache, None)
+            con.cursor().execute('SLEEP 300')
+            con.close()
+        finally:
+            pool.close()
+
+    def test_min_size_is_kept(self):
+        pool = sqlanydb.ConnectionPool(min_size=1, max_size=2,
+                                       max_lifetime=0.05,
+                                       uid='dba', pwd='sql')
+        try:
+            con = pool.acquire()
+            time.sleep(0.1)
+            con.close()
+            stats = pool.stats()
+            self.assertEqual((stats['size'], stats['idle'], stats['created'],
+                              stats['discarded']), (1, 1, 2, 1))
+        finally:
+            pool.close()
+        self.assertEqual(pool.stats()['size'], 0)
+
+    def test_release_evicts_idle(self):
+        pool = sqlanydb.ConnectionPool(max_size=2, max_idle=0.05,
+                                       uid='dba', pwd='sql')
+        try:
+            first, second = pool.acquire(), pool.acquire()
+            first.close()
+            time.sleep(0.1)
+            second.close()
+            stats = pool.stats()
+            self.assertEqual((stats['idle'], stats['discarded']), (1, 1))
+        finally:
+            pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -28,6 +28,9 @@ setup(name='sqlanydb',
       packages=find_packages(),
       py_modules=['sqlanydb'],
       license='Apache 2.0',
+      # for the fetch_numpy and fetch_arrow_batches tests, which are
+      # skipped without them
+      extras_require={'test': ['numpy', 'pyarrow']},
       classifiers=[
         'Development Status :: 5 - Production/Stable',
         'Intended Audience :: Developers',
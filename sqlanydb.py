@@ -31,8 +31,8 @@ import os
 import sys
 import atexit
 import time
-import logging
 import struct
+import threading
 
 
 
@@ -47,14 +47,39 @@ except:
     # 3.0 or later
     xrange = range
     v3list = list
+try:
+    import queue
+except ImportError:
+    # pre 3.0
+    import Queue as queue
 import codecs
+import errno
+import heapq
+import io
+import itertools
+import marshal
+import math
+import re
+from collections import deque, OrderedDict
 from ctypes import *
-from struct import pack, unpack, calcsize
+from struct import pack, pack_into, unpack, unpack_from, calcsize, Struct
+
+class Logger(object):
+    """Stands in for the module's logger so that importing sqlanydb does not
+    import logging.  Until the application imports logging no handler can
+    have been configured, so debug messages are dropped without it."""
 
-lg = logging.getLogger(__name__)
+    def __getattr__(self, level):
+        if level == 'debug' and 'logging' not in sys.modules:
+            return lambda *args, **kwargs: None
+        import logging
+        return getattr(logging.getLogger(__name__), level)
+
+lg = Logger()
 
 API_VERSION = 1
 API_VERSION_EX = 2
+API_VERSION_WIDE = 4
 
 # NB: The following must match those in sacapi.h for the specified API_VERSION!
 
@@ -130,6 +155,32 @@ class ColumnInfo(Structure):
                 ("nullable",    c_int32)]
 
 
+# API version 4 extends a_sqlany_data_value, and the structures that embed
+# it, so these are used instead when that version has been negotiated.
+
+class DataValueV4(DataValue):
+    """Must match a_sqlany_data_value for API version 4."""
+
+    _fields_ = [("is_address",  c_int32)]
+
+
+class BindParamV4(Structure):
+    """Must match a_sqlany_bind_param for API version 4."""
+
+    _fields_ = [("direction",   c_int),
+                ("value",       DataValueV4),
+                ("name",        c_char_p)]
+
+
+class ColumnInfoV4(ColumnInfo):
+    """Must match a_sqlany_column_info for API version 4."""
+
+    _fields_ = [("table_name",  c_char_p),
+                ("owner_name",  c_char_p),
+                ("is_bound",    c_int32),
+                ("binding",     DataValueV4)]
+
+
 class DataInfo(Structure):
     """Must match a_sqlany_data_info."""
 
@@ -138,7 +189,7 @@ class DataInfo(Structure):
                 ("is_null",     c_int),
                 ("data_size",   c_size_t)]
 
-def init_sacapi(api):
+def sacapi_prototypes():
     sacapi_i32 = c_int32
     sacapi_bool = sacapi_i32
     sacapi_u32 = c_uint32
@@ -152,11 +203,9 @@ def init_sacapi(api):
     p_sqlany_data_info = c_void_p
     p_sqlany_column_info = c_void_p
 
+    prototypes = {}
     def defun(name, *types):
-        try:
-            setattr(api, name, CFUNCTYPE(*types)((name, api),))
-        except:
-            pass
+        prototypes[name] = types
 
     defun("sqlany_init",
           sacapi_bool, c_char_p, sacapi_u32, p_sacapi_u32)
@@ -238,7 +287,55 @@ def init_sacapi(api):
         c_size_t, p_sqlany_connection, c_void_p, c_size_t)
     defun("sqlany_clear_error",
         None, p_sqlany_connection)
-    return api
+    defun("sqlany_reset_param_data",
+        sacapi_bool, p_sqlany_stmt)
+    defun("sqlany_error_length",
+        c_size_t, p_sqlany_connection)
+    defun("sqlany_set_batch_size",
+        sacapi_bool, p_sqlany_stmt, sacapi_u32)
+    defun("sqlany_set_param_bind_type",
+        sacapi_bool, p_sqlany_stmt, c_size_t)
+    defun("sqlany_get_batch_size",
+        sacapi_u32, p_sqlany_stmt)
+    defun("sqlany_set_rowset_size",
+        sacapi_bool, p_sqlany_stmt, sacapi_u32)
+    defun("sqlany_get_rowset_size",
+        sacapi_u32, p_sqlany_stmt)
+    defun("sqlany_set_column_bind_type",
+        sacapi_bool, p_sqlany_stmt, sacapi_u32)
+    defun("sqlany_bind_column",
+        sacapi_bool, p_sqlany_stmt, sacapi_u32, p_sqlany_data_value)
+    defun("sqlany_clear_column_bindings",
+        sacapi_bool, p_sqlany_stmt)
+    defun("sqlany_fetched_rows",
+        sacapi_i32, p_sqlany_stmt)
+    return prototypes
+
+SACAPI_PROTOTYPES = sacapi_prototypes()
+
+
+class SACAPI(CDLL):
+    """The dbcapi library.  Each function is given its prototype from
+    SACAPI_PROTOTYPES the first time it is used, rather than all of them
+    when the library is loaded.  Functions the library lacks raise
+    AttributeError.  While a Profile is active, they are bound wrapped
+    in ProfiledCalls."""
+
+    libraries = []
+
+    def __init__(self, *args, **kwargs):
+        CDLL.__init__(self, *args, **kwargs)
+        SACAPI.libraries.append(self)
+
+    def __getattr__(self, name):
+        types = SACAPI_PROTOTYPES.get(name)
+        if types is None:
+            return CDLL.__getattr__(self, name)
+        func = CFUNCTYPE(*types)((name, self))
+        if active_profile is not None:
+            func = ProfiledCall(active_profile, name, func)
+        setattr(self, name, func)
+        return func
 
 
 # NB: The preceding must match those in sacapi.h for the specified API_VERSION!
@@ -373,6 +470,16 @@ class NotSupportedError(DatabaseError):
     def __init__(self, *args):
         super(NotSupportedError,self).__init__(*args)
 
+class PoolTimeoutError(OperationalError):
+    """Raise when no pooled connection is free within the timeout."""
+    def __init__(self, *args):
+        super(PoolTimeoutError,self).__init__(*args)
+
+class QueryTimeoutError(OperationalError):
+    """Raise when a statement is cancelled for running past its timeout."""
+    def __init__(self, *args):
+        super(QueryTimeoutError,self).__init__(*args)
+
 def standardErrorHandler(connection, cursor, errorclass, errorvalue, sqlcode=0):
     error=(errorclass, errorvalue)
     if connection:
@@ -400,49 +507,553 @@ def mk_valueof(raw, char_set):
     return valueof
 
 
-def mk_assign(char_set):
-    def assign(param, value):
+def mk_view(size):
+    buffer = create_string_buffer(size)
+    view = memoryview(buffer)
+    # memoryviews can be cast from Python 3.3, and made read-only from 3.8
+    if hasattr(view, 'cast'):
+        view = view.cast('B')
+    if hasattr(view, 'toreadonly'):
+        view = view.toreadonly()
+    return buffer, view
+
+
+def mk_reader(data, a_type, raw, char_set, views=False):
+    """Return a function that decodes the value held in the DataValue data,
+    of the given A_* type.  The type of a column is fixed for the whole
+    result set, so the choice of decoding and the struct format are made
+    once.
+
+    Slicing data.buffer copies the value out of the dbcapi buffer in a
+    single memcpy.  If views is true, binary values are instead copied into
+    a buffer owned by the reader and returned as read-only memoryviews,
+    which are only valid until the next row is fetched."""
+    if views and a_type == A_BINARY:
+        # data.buffer as an integer address, without building a pointer
+        address = c_void_p.from_buffer(data)
+        state = [None, memoryview(b'')]
+        def read():
+            if data.is_null[0]:
+                return None
+            length = data.length[0]
+            if length > len(state[1]):
+                state[:] = mk_view(max(length, 2 * len(state[1])))
+            memmove(state[0], address.value, length)
+            return state[1][:length]
+    elif a_type in raw:
+        def read():
+            if data.is_null[0]:
+                return None
+            return data.buffer[:data.length[0]]
+    elif a_type == A_STRING:
+        def read():
+            if data.is_null[0]:
+                return None
+            return data.buffer[:data.length[0]].decode(char_set)
+    else:
+        fmt = Struct(format[a_type])
+        unpack_value, size = fmt.unpack, fmt.size
+        def read():
+            if data.is_null[0]:
+                return None
+            return unpack_value(data.buffer[:size])[0]
+    return read
+
+
+# Rows fetched per call by a wide fetch, unless limited by ROWSET_BYTES
+ROWSET_SIZE = 1024
+
+# Upper bound on the size of the arrays bound for a wide fetch
+ROWSET_BYTES = 1 << 22
+
+# Worst case growth of character data converted to the connection charset
+CHARSET_GROWTH = 3
+
+# Chunk size of a ColumnReader, unless set with Cursor.setoutputsize()
+LOB_CHUNK_SIZE = 1 << 16
+
+# Columns that Cursor.setoutputsize() turns into ColumnReaders
+LONG_TYPES = frozenset([DT_LONGVARCHAR, DT_LONGBINARY, DT_LONGNVARCHAR])
+
+
+def mk_rowset(api, stmt, DataValue, types, sizes, rows, raw, char_set):
+    """Bind each column of the result set of stmt to arrays holding up to
+    rows values, for API version 4 wide fetches.
+
+    types holds an (A_* type, DT_* native type) pair per column and sizes
+    the maximum size of each column.  Returns a function that decodes the
+    first n rows of the arrays after a fetch into a list of tuples, the
+    (buffer, nulls, read) arrays and column reader bound to each column,
+    and a function that binds the arrays again, or None if the result set
+    cannot be fetched this way.  The decoding function calls
+    ontruncate(column) for values that did not fit their array."""
+    widths = []
+    for (a_type, native_type), max_size in zip(types, sizes):
+        if a_type == A_STRING:
+            widths.append(CHARSET_GROWTH * max_size + 1)
+        elif a_type == A_BINARY:
+            widths.append(max_size)
+        else:
+            widths.append(calcsize(format[a_type]))
+    if sum(widths) > ROWSET_BYTES:
+        return None
+    rows = max(1, min(rows, ROWSET_BYTES // max(1, sum(widths))))
+    if not api.sqlany_set_rowset_size(stmt, rows):
+        return None
+    columns, bound = [], []
+    for i, ((a_type, native_type), width) in enumerate(zip(types, widths)):
+        value = DataValue()
+        buffer = create_string_buffer(max(1, width * rows))
+        lengths = (c_size_t * rows)()
+        nulls = (c_int * rows)()
+        value.buffer = cast(buffer, POINTER(c_char))
+        value.buffer_size = width
+        value.length = cast(lengths, POINTER(c_size_t))
+        value.type = a_type
+        value.is_null = cast(nulls, POINTER(c_int))
+        if not api.sqlany_bind_column(stmt, i, byref(value)):
+            api.sqlany_clear_column_bindings(stmt)
+            api.sqlany_set_rowset_size(stmt, 1)
+            return None
+        read = mk_column(buffer, a_type, width, lengths, raw, char_set)
+        columns.append((value, nulls, read,
+                        CONVERSION_CALLBACKS.get(native_type)))
+        bound.append((buffer, nulls, read))
+
+    def decode(n, ontruncate):
+        values = []
+        for i, (value, nulls, read, converter) in enumerate(columns):
+            column = read(n, i, ontruncate)
+            flags = nulls[:n]
+            if any(flags):
+                column = [None if null else v
+                          for v, null in zip(column, flags)]
+            if converter is not None:
+                column = [converter(v) for v in column]
+            values.append(column)
+        return v3list(zip(*values))
+
+    def bind():
+        for i, (value, nulls, read, converter) in enumerate(columns):
+            api.sqlany_bind_column(stmt, i, byref(value))
+    return decode, bound, bind
+
+
+def mk_column(buffer, a_type, width, lengths, raw, char_set):
+    """Return a function that decodes the first n values of a column bound
+    to buffer, an array of values of the given width."""
+    if a_type in raw or a_type == A_STRING:
+        # strings are terminated, so filling the whole width means truncation
+        limit = width if a_type in raw else width - 1
+        def read(n, i, ontruncate):
+            sizes = lengths[:n]
+            if max(sizes) > limit:
+                ontruncate(i)
+            values = [buffer[offset:offset + size] for offset, size
+                      in zip(range(0, n * width, width), sizes)]
+            if a_type not in raw:
+                values = [v.decode(char_set) for v in values]
+            return values
+    else:
+        fmt = format[a_type]
+        def read(n, i, ontruncate):
+            return unpack_from('%d%s' % (n, fmt), buffer)
+    return read
+
+
+# NumPy dtypes of the fixed size A_* types, for Cursor.fetch_numpy()
+NUMPY_DTYPES = {A_DOUBLE: 'f8',
+                A_VAL64:  'i8', A_UVAL64: 'u8',
+                A_VAL32:  'i4', A_UVAL32: 'u4',
+                A_VAL16:  'i2', A_UVAL16: 'u2',
+                A_VAL8:   'i1', A_UVAL8:  'u1'}
+
+
+def numpy_dtype(a_type, native_type):
+    """Return the dtype of the array Cursor.fetch_numpy() fetches a column
+    into: a number or bool type, or 'O' for values left as Python objects,
+    including those of columns with a converter."""
+    if native_type in CONVERSION_CALLBACKS:
+        return 'O'
+    if native_type == DT_BIT:
+        return '?'
+    return NUMPY_DTYPES.get(a_type, 'O')
+
+
+def mk_converted(read, converter):
+    def convert():
+        return converter(read())
+    return convert
+
+
+def mk_decoder(api, DataValue, types, raw, char_set, views=False,
+               streamed=()):
+    """Build the row decoder for a result set.
+
+    types holds an (A_* type, DT_* native type) pair per column, as
+    returned by Cursor.columns().  The decoder reuses one DataValue per
+    column and only calls the converters that have been registered.
+    The columns in streamed are not fetched; their value is whatever
+    the stream callback passed to the decoder returns for them."""
+    get_column = api.sqlany_get_column
+    columns = []
+    for i, (a_type, native_type) in enumerate(types):
+        if i in streamed:
+            columns.append((i, None, None))
+            continue
+        value = DataValue()
+        read = mk_reader(value, a_type, raw, char_set, views)
+        converter = CONVERSION_CALLBACKS.get(native_type)
+        if converter is not None:
+            read = mk_converted(read, converter)
+        columns.append((i, byref(value), read))
+    if streamed:
+        def decode(stmt, ontruncate, stream):
+            row = []
+            append = row.append
+            for i, ref, read in columns:
+                if ref is None:
+                    append(stream(i))
+                    continue
+                if get_column(stmt, i, ref) < 0:
+                    ontruncate(i)
+                append(read())
+            return tuple(row)
+    else:
+        def decode(stmt, ontruncate, stream=None):
+            row = []
+            append = row.append
+            for i, ref, read in columns:
+                if get_column(stmt, i, ref) < 0:
+                    ontruncate(i)
+                append(read())
+            return tuple(row)
+    return decode
+
+
+def infer_type(value):
+    """Return the A_* type to bind value as, when dbcapi does not describe
+    the type of its parameter."""
+    if isinstance(value, int):
+        if value >= 0:
+            return A_UVAL64
+        else:
+            return A_VAL64
+    elif isinstance(value, float):
+        return A_DOUBLE
+    elif isinstance(value, Binary):
+        return A_BINARY
+    else:
+        return A_STRING
+
+
+def is_stream(value):
+    """Return whether value is a parameter to be sent in pieces with
+    sqlany_send_param_data: a memoryview, a file object or an iterator
+    of bytes or strings."""
+    return (isinstance(value, memoryview) or hasattr(value, 'read') or
+            hasattr(value, '__next__') or hasattr(value, 'next'))
+
+
+def stream_chunks(value, chunk_size, char_set):
+    """Yield the pieces of a streamed parameter as (data, size) pairs to
+    pass to sqlany_send_param_data.  A file is read into one reusable
+    buffer, and a writable memoryview is sent without copying it."""
+    if isinstance(value, memoryview):
+        if hasattr(value, 'cast'):
+            value = value.cast('B')
+        size = len(value)
+        if not value.readonly:
+            yield (c_char * size).from_buffer(value), size
+            return
+        chunks = (value[i:i+chunk_size].tobytes()
+                  for i in range(0, size, chunk_size))
+    elif hasattr(value, 'readinto'):
+        buffer = bytearray(chunk_size)
+        data = (c_char * chunk_size).from_buffer(buffer)
+        while True:
+            size = value.readinto(buffer)
+            if not size:
+                return
+            yield data, size
+    elif hasattr(value, 'read'):
+        chunks = iter(lambda: value.read(chunk_size) or None, None)
+    else:
+        chunks = value
+    for chunk in chunks:
+        if isinstance(chunk, bytes):
+            pass
+        elif isinstance(chunk, str):
+            chunk = chunk.encode(char_set)
+        else:
+            chunk = bytes(chunk)
+        if chunk:
+            yield chunk, len(chunk)
+
+
+class ParameterBinder(object):
+    """Binds rows of parameters to a prepared statement.
+
+    The parameters are described once per statement.  Each one keeps its
+    BindParam and a buffer that grows to the largest value bound so far.
+    dbcapi reads bound buffers when the statement is executed, so
+    sqlany_bind_param is only called again when the type of a parameter or
+    its buffer changes, and otherwise each row is copied into the buffers.
+    Streamed values are bound without a buffer and sent by send()."""
+
+    def __init__(self, api, stmt, BindParam, char_set):
+        self.api = api
+        self.stmt = stmt
+        self.char_set = char_set
+        self.described = []
+        self.params = []
+        self.buffers = []
+        self.lengths = []
+        self.nulls = []
+        for k in range(api.sqlany_num_params(stmt)):
+            described = BindParam()
+            api.sqlany_describe_bind_param(stmt, k, byref(described))
+            param = BindParam.from_buffer_copy(described)
+            length, is_null = c_size_t(0), c_int(0)
+            param.value.length = pointer(length)
+            param.value.is_null = pointer(is_null)
+            self.described.append(described)
+            self.params.append(param)
+            self.buffers.append(None)
+            self.lengths.append(length)
+            self.nulls.append(is_null)
+        self.declared = [None] * len(self.params)
+        self.streams = []
+        self.invalidate()
+
+    def __len__(self):
+        return len(self.params)
+
+    def declare(self, sizes):
+        """Fix the types of the parameters and reserve their buffers, as
+        given by the items passed to Cursor.setinputsizes(), or drop any
+        earlier declarations if sizes is None."""
+        self.declared = [None] * len(self.params)
+        for k, size in enumerate((sizes or ())[:len(self.params)]):
+            a_type, capacity = input_size(size)
+            self.declared[k] = a_type
+            buffer = self.buffers[k]
+            if capacity and (buffer is None or sizeof(buffer) <= capacity):
+                self.buffers[k] = create_string_buffer(capacity + 1)
+
+    def describe(self, k):
+        """Return a copy of the description of parameter k, with its
+        declared type if it has one."""
+        param = type(self.described[k]).from_buffer_copy(self.described[k])
+        if self.declared[k] is not None:
+            param.value.type = self.declared[k]
+        return param
+
+    def invalidate(self):
+        """Make the next row bind every parameter again, for when the
+        statement has been reset or bound to something else."""
+        self.bound = [None] * len(self.params)
+
+    def bind(self, parameters):
+        """Bind one row of parameters and return their BindParams."""
+        self.streams = []
+        params = self.params[:len(parameters)]
+        for k, value in enumerate(parameters[:len(params)]):
+            self.assign(k, value)
+        return params
+
+    def assign(self, k, value, a_type=None):
+        """Copy value into the buffer of parameter k, binding it again if
+        need be.  a_type overrides the declared and described types."""
+        param = self.params[k]
         is_null = value is None
-        param.value.is_null = pointer(c_int(is_null))
+        self.nulls[k].value = is_null
         if is_null and param.direction == DD_INPUT:
             value = 0
-        if param.value.type == A_INVALID_TYPE:
+        if a_type is None:
+            a_type = self.declared[k]
+        if a_type is None:
+            a_type = self.described[k].value.type
+        if a_type == A_INVALID_TYPE:
             if is_null and param.direction == DD_INPUT:
-                param.value.type = A_STRING
-            elif isinstance(value, int):
-                if value >= 0:
-                    param.value.type = A_UVAL64
-                else:
-                    param.value.type = A_VAL64
-            elif isinstance(value, float):
-                param.value.type = A_DOUBLE
-            elif isinstance(value, Binary):
-                param.value.type = A_BINARY
+                a_type = A_STRING
             else:
-                param.value.type = A_STRING
-        fmt = format[param.value.type]
+                a_type = infer_type(value)
+        fmt = format[a_type]
         if fmt == 'x':
             if isinstance(value, bytes):
                 pass
             elif isinstance(value, str):
-                value = value.encode(char_set)
+                value = value.encode(self.char_set)
+            elif is_stream(value):
+                self.bind_stream(k, a_type)
+                self.streams.append((k, value))
+                return
             else:
-                value = str(value).encode(char_set)
+                value = str(value).encode(self.char_set)
             size = length = len(value)
             if param.direction != DD_INPUT:
-                if size < param.value.buffer_size:
-                    size = param.value.buffer_size
-            buffer = create_string_buffer(value)
+                if size < self.described[k].value.buffer_size:
+                    size = self.described[k].value.buffer_size
         else:
-            buffer = create_string_buffer(pack(fmt, value))
             size = length = calcsize(fmt)
+        buffer = self.buffers[k]
+        if buffer is None or sizeof(buffer) <= size:
+            capacity = size + 1
+            if buffer is not None:
+                capacity = max(capacity, 2 * sizeof(buffer))
+            buffer = self.buffers[k] = create_string_buffer(capacity)
+        if fmt == 'x':
+            memmove(buffer, value, length)
+            buffer[length] = b'\0'
+            size = sizeof(buffer) - 1
+        else:
+            try:
+                pack_into(fmt, buffer, 0, value)
+            except struct.error:
+                # a value that does not fit the declared or described
+                # type is bound as the type of the value, or as a string
+                inferred = infer_type(value)
+                if inferred == a_type:
+                    inferred = A_STRING
+                return self.assign(k, value, inferred)
+        self.lengths[k].value = length
+        if self.bound[k] != (a_type, buffer, size):
+            param.value.type = a_type
+            param.value.buffer = cast(buffer, POINTER(c_char))
+            param.value.buffer_size = size
+            self.api.sqlany_bind_param(self.stmt, k, byref(param))
+            self.bound[k] = (a_type, buffer, size)
+
+    def bind_stream(self, k, a_type):
+        """Bind parameter k without a buffer, for its value to be sent
+        with sqlany_send_param_data."""
+        param = self.params[k]
+        self.lengths[k].value = 0
+        if self.bound[k] != (a_type, None, 0):
+            param.value.type = a_type
+            param.value.buffer = None
+            param.value.buffer_size = 0
+            self.api.sqlany_bind_param(self.stmt, k, byref(param))
+            self.bound[k] = (a_type, None, 0)
+
+    def send(self, chunk_size):
+        """Send the streamed values of the row just bound.  Returns False
+        if dbcapi refused a piece."""
+        streams, self.streams = self.streams, []
+        for k, value in streams:
+            for data, size in stream_chunks(value, chunk_size, self.char_set):
+                if not self.api.sqlany_send_param_data(self.stmt, k,
+                                                       data, size):
+                    return False
+        return True
+
+
+# Limits on the rows, and the size of the arrays, bound for a batch execute
+BATCH_SIZE = 1024
+BATCH_BYTES = 1 << 22
+
+
+def batches(seq_of_parameters, bind_count):
+    """Split seq_of_parameters into lists of rows to be executed as one
+    batch each, estimating the size of the arrays they will be bound to."""
+    batch, widths = [], [0] * bind_count
+    for parameters in seq_of_parameters:
+        for k, value in enumerate(parameters[:bind_count]):
+            if isinstance(value, (bytes, str)):
+                width = len(value)
+            else:
+                width = 8
+            if width > widths[k]:
+                widths[k] = width
+        batch.append(parameters)
+        if len(batch) >= BATCH_SIZE or sum(widths) * len(batch) >= BATCH_BYTES:
+            yield batch
+            batch, widths = [], [0] * bind_count
+    if batch:
+        yield batch
+
+
+def input_size(size):
+    """Return the A_* type, or None to infer it from each value, and the
+    buffer size to reserve for an item passed to Cursor.setinputsizes().
+    An item is None, a maximum length, a type object such as STRING, or
+    one of the Python types int, float, str, bytes and Binary."""
+    if size is int:
+        return A_VAL64, calcsize(format[A_VAL64])
+    elif size is float:
+        return A_DOUBLE, calcsize(format[A_DOUBLE])
+    elif size is str:
+        return A_STRING, 0
+    elif size is bytes or size is Binary:
+        return A_BINARY, 0
+    elif size is BINARY:
+        return A_BINARY, 0
+    elif size is STRING or size is DATE or size is TIME or size is DATETIME:
+        return A_STRING, 0
+    elif isinstance(size, int) and not isinstance(size, bool):
+        return None, size
+    return None, 0
+
+
+def mk_assign_batch(char_set):
+    def assign_batch(param, values):
+        """Bind param to arrays holding values, one per row of a batch.
+        Returns the arrays, which must be kept alive until the batch has
+        been executed, or None if the values cannot share one type."""
+        if param.direction != DD_INPUT:
+            return None
+        n = len(values)
+        nulls = (c_int * n)(*[value is None for value in values])
+        if param.value.type == A_INVALID_TYPE:
+            types = set(infer_type(value) for value in values
+                        if value is not None)
+            if not types:
+                param.value.type = A_STRING
+            elif types == set((A_VAL64, A_UVAL64)):
+                param.value.type = A_VAL64
+            elif len(types) == 1:
+                param.value.type = types.pop()
+            else:
+                return None
+        fmt = format[param.value.type]
+        if fmt == 'x':
+            data = []
+            for value in values:
+                if value is None:
+                    value = b''
+                elif isinstance(value, bytes):
+                    pass
+                elif isinstance(value, str):
+                    value = value.encode(char_set)
+                elif is_stream(value):
+                    # streamed values are sent one row at a time
+                    return None
+                else:
+                    value = str(value).encode(char_set)
+                data.append(value)
+            lengths = (c_size_t * n)(*[len(value) for value in data])
+            size = max(1, max(lengths))
+            data = b''.join(value.ljust(size, b'\0') for value in data)
+        else:
+            try:
+                data = pack('%d%s' % (n, fmt),
+                            *[0 if value is None else value
+                              for value in values])
+            except struct.error:
+                return None
+            size = calcsize(fmt)
+            lengths = (c_size_t * n)(*(size,) * n)
+        buffer = create_string_buffer(data, len(data))
         param.value.buffer = cast(buffer, POINTER(c_char))
         param.value.buffer_size = c_size_t(size)
-        param.value.length = pointer(c_size_t(length))
-    return assign
+        param.value.length = cast(lengths, POINTER(c_size_t))
+        param.value.is_null = cast(nulls, POINTER(c_int))
+        return buffer, lengths, nulls
+    return assign_batch
 
 
-threadsafety = 1
+threadsafety = 2
 apilevel     = '2.0'
 paramstyle   = 'qmark'
 
@@ -480,14 +1091,17 @@ def load_library(*names):
         if name is None or name == '':
             continue
         try:
-            dll = cdll.LoadLibrary(name)
+            dll = SACAPI(name)
             lg.debug("Successfully loaded dbcapi library '%s' with name '%s'", dll, name)
-            return init_sacapi(dll)
+            return dll
         except OSError as ose:
             continue
     raise InterfaceError("Could not load dbcapi.  Tried: " + ','.join(map(str, names)))
 
 
+# guards the creation of the Root and its list of connections
+root_lock = threading.RLock()
+
 class Root(object):
     connections = []
     def __init__(self, name):
@@ -498,10 +1112,13 @@ class Root(object):
         ver = c_uint(0)
         try:
             self.api.sqlany_init_ex.restype = POINTER(c_int)
-            lg.debug("Attempting to initalize dbcapi context (self.api.sqlany_init_ex) with arguments:" \
-                " app name: '%s', api version: '%s'",
-                name, API_VERSION_EX)
-            context = self.api.sqlany_init_ex(name.encode('utf-8'), API_VERSION_EX, byref(ver))
+            for version in (API_VERSION_WIDE, API_VERSION_EX):
+                lg.debug("Attempting to initalize dbcapi context (self.api.sqlany_init_ex) with arguments:" \
+                    " app name: '%s', api version: '%s'",
+                    name, version)
+                context = self.api.sqlany_init_ex(name.encode('utf-8'), version, byref(ver))
+                if context:
+                    break
             if not context:
                 lg.error("Failed to initalize dbcapi context (self.api.sqlany_init_ex returned NULL)," \
                     "perhaps you are missing some required sqlanywhere libaries?")
@@ -511,6 +1128,7 @@ class Root(object):
                         API_VERSION_EX)
             else:
                 lg.debug("Initalization of dbcapi context successful, max api version supported: %s", ver)
+            self.api_version = version
 
             def new_connection():
                 return self.api.sqlany_new_connection_ex(context)
@@ -535,6 +1153,13 @@ class Root(object):
                 raise InterfaceError("dbcapi version %d required." %
                         API_VERSION)
             self.api.sqlany_new_connection.restype = POINTER(c_int)
+            self.api_version = API_VERSION
+        if self.api_version >= API_VERSION_WIDE:
+            self.DataValue, self.BindParam, self.ColumnInfo = \
+                DataValueV4, BindParamV4, ColumnInfoV4
+        else:
+            self.DataValue, self.BindParam, self.ColumnInfo = \
+                DataValue, BindParam, ColumnInfo
         # Need to set return type to some pointer type other than void
         # to avoid automatic conversion to a (32 bit) int.
         self.api.sqlany_prepare.restype = POINTER(c_int)
@@ -555,10 +1180,12 @@ class Root(object):
             self.api = None
 
     def add_conn(self, conn):
-        self.connections.append(conn)
+        with root_lock:
+            self.connections.append(conn)
 
     def remove_conn(self, conn):
-        self.connections.remove(conn);
+        with root_lock:
+            self.connections.remove(conn);
 
 
 def connect(*args, **kwargs):
@@ -566,11 +1193,575 @@ def connect(*args, **kwargs):
     return Connection(args, kwargs)
 
 
-class Connection(object):
+class StatementCache(object):
+    """Prepared statements of a connection that no cursor is using, keyed
+    by their SQL text.  Once there are more than size of them, the least
+    recently used are freed."""
+
+    def __init__(self, api, size):
+        self.api = api
+        self.size = size
+        self.statements = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.statements)
+
+    def get(self, operation):
+        """Take the statement prepared for operation, and its
+        ParameterBinder, out of the cache.  Returns (None, None) if there
+        is none."""
+        if self.size <= 0:
+            return None, None
+        stmt, binder = self.statements.pop(operation, (None, None))
+        if stmt is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return stmt, binder
+
+    def put(self, operation, stmt, binder=None):
+        """Reset stmt, prepared for operation, and keep it for reuse, or
+        free it if it cannot be kept."""
+        if (self.size <= 0 or operation in self.statements or
+                not self.api.sqlany_reset(stmt)):
+            self.api.sqlany_free_stmt(stmt)
+            return
+        if binder is not None:
+            binder.invalidate()
+        self.statements[operation] = (stmt, binder)
+        while len(self.statements) > self.size:
+            operation, (stmt, binder) = self.statements.popitem(last=False)
+            self.api.sqlany_free_stmt(stmt)
+            self.evictions += 1
+
+    def clear(self):
+        while self.statements:
+            operation, (stmt, binder) = self.statements.popitem()
+            self.api.sqlany_free_stmt(stmt)
+
+
+# the tokens of a SQL statement: string literals, quoted identifiers,
+# comments, white space, words and single characters
+SQL_TOKEN = re.compile(r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|\[[^\]]*\]"""
+                       r"""|--[^\n]*|//[^\n]*|/\*.*?\*/|\s+|[\w$#@]+|.""",
+                       re.S)
+
+# words followed by the names of the tables a statement reads or writes
+TABLE_KEYWORDS = frozenset(['from', 'join', 'update', 'into', 'table',
+                            'delete', 'insert'])
+
+# words that end a list of tables, so are neither a table nor an alias
+SQL_CLAUSES = frozenset([
+    'select', 'from', 'where', 'join', 'inner', 'left', 'right', 'full',
+    'outer', 'cross', 'natural', 'apply', 'key', 'on', 'using', 'group',
+    'order', 'having', 'union', 'except', 'intersect', 'minus', 'set',
+    'values', 'with', 'for', 'option', 'into', 'window', 'limit', 'top',
+    'start', 'as', 'lateral', 'default'])
+
+# statements that neither read nor write tables
+NEUTRAL_STATEMENTS = frozenset(['set', 'declare', 'waitfor', 'message',
+                                'print'])
+
+# functions whose results may differ each time a query calls them
+VOLATILE_FUNCTIONS = frozenset([
+    'newid', 'rand', 'now', 'getdate', 'today', 'current_timestamp',
+    'current_date', 'current_time', 'connection_property', 'db_property',
+    'property', 'next_connection', 'next_database', 'event_parameter',
+    'get_identity', 'errormsg', 'openstring', 'xp_read_file',
+    'read_client_file', 'varexists'])
+
+# special values that may differ each time they are read, besides global
+# variables such as @@identity
+VOLATILE_VALUES = frozenset(['current_timestamp', 'current_date',
+                             'current_time', 'current_utc_timestamp',
+                             'nextval', 'currval'])
+
+# words that follow current in a special value of the clock,
+# such as current timestamp
+CURRENT_VALUES = frozenset(['timestamp', 'date', 'time', 'utc'])
+
+# the table of every result, written by statements whose tables are unknown
+ALL_TABLES = '*'
+
+RESULT_CACHE_TTL = 60.0
+
+# the size of a value in a cached result, besides the length of a string
+# or binary value
+VALUE_BYTES = 16
+
+# the number of statements a ResultCache remembers parsing
+PARSED_STATEMENTS = 1000
+
+def is_table_name(word):
+    return bool(word) and (word[0].isalpha() or word[0] in '_$#@') and \
+        word not in SQL_CLAUSES
+
+def is_volatile(words):
+    """Whether the words of a query call a function, or read a value,
+    that may differ each time the query runs."""
+    for i, word in enumerate(words):
+        following = words[i + 1] if i + 1 < len(words) else None
+        if word in VOLATILE_FUNCTIONS and following == '(':
+            return True
+        if word in VOLATILE_VALUES or word[:2] == '@@':
+            return True
+        if word == 'current' and following in CURRENT_VALUES:
+            return True
+    return False
+
+def parse_statement(operation):
+    """Return the text of a SQL statement normalized for a ResultCache,
+    without comments, with white space collapsed and all but string
+    literals in lower case; its kind, 'read' for a query whose results
+    can be cached, 'write', 'end' for the end of a transaction, or None;
+    and the frozenset of the tables it names.  A batch of statements
+    separated by semicolons, and a query that selects from a procedure,
+    are writes of every table."""
+    if isinstance(operation, bytes):
+        operation = operation.decode('latin-1')
+    text = []
+    words = []
+    for token in SQL_TOKEN.findall(operation):
+        if token[0].isspace() or token[:2] in ('--', '//', '/*'):
+            if text and text[-1] != ' ':
+                text.append(' ')
+            continue
+        if token[0] != "'":
+            token = token.lower()
+        text.append(token)
+        if token[0] in '"[':
+            token = token[1:-1]
+        words.append(token)
+    text = ''.join(text).strip().rstrip(';').rstrip()
+    while words and words[-1] == ';':
+        words.pop()
+
+    tables = set()
+    calls = False
+    i, n = 0, len(words)
+    while i < n:
+        i += 1
+        if words[i - 1] not in TABLE_KEYWORDS:
+            continue
+        while i < n and is_table_name(words[i]):
+            # the table of owner.table
+            while (i + 2 < n and words[i + 1] == '.' and
+                   is_table_name(words[i + 2])):
+                i += 2
+            tables.add(words[i])
+            if i + 1 < n and words[i + 1] == '(':
+                # a procedure called for its result set
+                calls = True
+            i += 1
+            if i < n and words[i] == 'as':
+                i += 1
+            if i < n and is_table_name(words[i]):
+                i += 1
+            if i < n and words[i] == ',':
+                i += 1
+            else:
+                break
+
+    first = words[0] if words else None
+    if ';' in words:
+        # a batch, which may write any table whatever its first statement
+        kind = 'write'
+        tables.add(ALL_TABLES)
+    elif first in ('select', 'with'):
+        if 'into' in words:
+            kind = 'write'
+        elif 'update' in words:
+            # select ... for update
+            kind = None
+        elif calls:
+            # like a call, a procedure may write any table
+            kind = 'write'
+            tables.add(ALL_TABLES)
+        elif is_volatile(words):
+            kind = None
+        else:
+            kind = 'read'
+    elif first in NEUTRAL_STATEMENTS or first is None:
+        kind = None
+    elif first in ('commit', 'rollback') and 'savepoint' not in words:
+        kind = 'end'
+    else:
+        kind = 'write'
+        if not tables:
+            tables.add(ALL_TABLES)
+    return text, kind, frozenset(tables)
+
+def result_key(text, parameters):
+    """Return the key in a ResultCache of the result of the query text,
+    as normalized by parse_statement(), run with parameters, or None if
+    the parameters cannot be part of a key."""
+    parameters = tuple(parameters)
+    if any(is_stream(value) for value in parameters):
+        return None
+    key = (text, parameters, tuple(type(value) for value in parameters))
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+class ResultCache(object):
+    """The result sets of queries, kept for ttl seconds so that running a
+    query again with the same parameters need not go to the server.
+    Queries are matched on their text, ignoring comments, white space and
+    the case of all but string literals.  Once the results kept come to
+    more than size bytes, by an estimate, the least recently used are
+    dropped.
+
+    Each result is tagged with the tables its query names.  A statement
+    run on the connection that writes to one of them drops it, and the
+    table is not cached again until the transaction ends.  Writes the
+    statement does not name, through a view or a trigger say, are not
+    seen: invalidate() drops the results of tables changed that way.  A
+    statement whose tables cannot be told, such as a call, drops every
+    result.  Connections to one database can share a cache by each being
+    given it as result_cache, but it only sees their own writes."""
+
+    def __init__(self, size, ttl=RESULT_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        # key -> (expiry time, tables, size, result)
+        self.results = OrderedDict()
+        # table -> keys of the results tagged with it
+        self.tables = {}
+        self.statements = {}
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.results)
+
+    def parse(self, operation):
+        """Return parse_statement(operation), remembered for the
+        statements parsed most recently."""
+        parsed = self.statements.get(operation)
+        if parsed is None:
+            if len(self.statements) >= PARSED_STATEMENTS:
+                self.statements.clear()
+            parsed = self.statements[operation] = parse_statement(operation)
+        return parsed
+
+    def get(self, key):
+        """Return the result kept for key, or None if it has none that has
+        not expired."""
+        with self.lock:
+            entry = self.results.pop(key, None)
+            if entry is not None and entry[0] <= clock():
+                self.results[key] = entry
+                self.discard(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.results[key] = entry
+            self.hits += 1
+            return entry[3]
+
+    def put(self, key, tables, ttl, result, size):
+        """Keep result for ttl seconds, or the cache's ttl if None, tagged
+        with tables and taking size bytes."""
+        if ttl is None:
+            ttl = self.ttl
+        with self.lock:
+            if key in self.results:
+                self.discard(key)
+            self.results[key] = (clock() + ttl, tables, size, result)
+            self.bytes += size
+            for table in tables:
+                self.tables.setdefault(table, set()).add(key)
+            while self.bytes > self.size:
+                self.discard(next(iter(self.results)))
+                self.evictions += 1
+
+    def discard(self, key):
+        expires, tables, size, result = self.results.pop(key)
+        self.bytes -= size
+        for table in tables:
+            keys = self.tables[table]
+            keys.discard(key)
+            if not keys:
+                del self.tables[table]
+
+    def invalidate(self, *tables):
+        """Drop the results of the queries that name any of tables."""
+        if ALL_TABLES in tables:
+            return self.clear()
+        with self.lock:
+            for table in tables:
+                for key in list(self.tables.get(table.lower(), ())):
+                    self.discard(key)
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+            self.tables.clear()
+            self.bytes = 0
+
+
+# The Profile recording dbcapi calls, if one is active
+active_profile = None
+
+# Buckets of a Profile's call time histograms per doubling of the time
+PROFILE_BUCKETS = 8
+
+cursor_numbers = itertools.count(1)
+
+def perf_ns():
+    return int(time.perf_counter() * 1e9)
+perf_ns = getattr(time, 'perf_counter_ns', perf_ns)
+
+
+class ProfiledCall(object):
+    """A dbcapi function that records its calls in a Profile while it is
+    active.  Other attributes, such as restype, are those of the
+    function."""
+
+    __slots__ = ('profile', 'name', 'func')
+
+    def __init__(self, profile, name, func):
+        object.__setattr__(self, 'profile', profile)
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'func', func)
+
+    def __call__(self, *args):
+        profile = self.profile
+        if not profile.active:
+            return self.func(*args)
+        start = perf_ns()
+        try:
+            return self.func(*args)
+        finally:
+            profile.record(self.name, args, perf_ns() - start)
+
+    def __getattr__(self, name):
+        return getattr(self.func, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.func, name, value)
+
+
+class Profile(object):
+    """Counts and times the calls made to dbcapi while it is active, in
+    total for the process and for each cursor, by the statement handle
+    passed.  Made by profile(); used in a with statement, it is active
+    in the block and writes report() to file when the block ends."""
+
+    def __init__(self, file=None):
+        self.file = file
+        self.active = False
+        self.lock = threading.Lock()
+        # function name -> [calls, total ns, {bucket: calls}]
+        self.process = {}
+        # cursor label -> the same, for calls on its statements
+        self.cursors = {}
+        # statement handle address -> label of the cursor using it
+        self.owners = {}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc, value, tb):
+        self.stop()
+        (self.file or sys.stderr).write(self.report())
+
+    def start(self):
+        global active_profile
+        if active_profile is not None:
+            raise InterfaceError("a profile is already active")
+        self.active = True
+        active_profile = self
+        for api in SACAPI.libraries:
+            for name, func in list(vars(api).items()):
+                if (name in SACAPI_PROTOTYPES and hasattr(func, 'restype')
+                        and not isinstance(func, ProfiledCall)):
+                    setattr(api, name, ProfiledCall(self, name, func))
+        with root_lock:
+            parent = Connection.cls_parent
+            connections = list(parent.connections) if parent else []
+        for connection in connections:
+            for cursor in list(connection.cursors or ()):
+                stmt = cursor._Cursor__stmt
+                if stmt:
+                    self.own(stmt, cursor)
+
+    def stop(self):
+        global active_profile
+        self.active = False
+        active_profile = None
+        # functions already fetched from the library stay wrapped, but
+        # call straight through
+        for api in SACAPI.libraries:
+            for name, func in list(vars(api).items()):
+                if isinstance(func, ProfiledCall) and func.profile is self:
+                    setattr(api, name, func.func)
+
+    def own(self, stmt, cursor):
+        operation = cursor.operation
+        if isinstance(operation, bytes):
+            operation = operation.decode(cursor.char_set, 'replace')
+        self.owners[handle_address(stmt)] = "cursor %d: %s" % (cursor.number,
+                                                              operation)
+
+    def record(self, name, args, ns):
+        bucket = int(math.log(ns, 2) * PROFILE_BUCKETS) if ns > 0 else 0
+        owner = self.owners.get(handle_address(args[0])) if args else None
+        with self.lock:
+            tables = [self.process]
+            if owner is not None:
+                tables.append(self.cursors.setdefault(owner, {}))
+            for table in tables:
+                entry = table.get(name)
+                if entry is None:
+                    entry = table[name] = [0, 0, {}]
+                entry[0] += 1
+                entry[1] += ns
+                entry[2][bucket] = entry[2].get(bucket, 0) + 1
+
+    def stats(self, cursor=None):
+        """Return {function name: (calls, total seconds, median seconds,
+        99th percentile seconds)} for the whole process, or for the
+        cursor with the given label.  Percentiles are estimated to
+        within a tenth."""
+        with self.lock:
+            table = self.process if cursor is None else self.cursors[cursor]
+            return dict((name, (calls, total / 1e9,
+                                percentile(histogram, calls, 0.5),
+                                percentile(histogram, calls, 0.99)))
+                        for name, (calls, total, histogram)
+                        in table.items())
+
+    def report(self):
+        """Return a table of the calls, for the process and each cursor,
+        slowest in total first."""
+        lines = []
+        sections = [("process", None)]
+        sections += [(label, label) for label in sorted(self.cursors)]
+        for title, cursor in sections:
+            lines.append(title)
+            lines.append("  %-30s %9s %11s %10s %10s %10s" %
+                         ("function", "calls", "total ms", "mean us",
+                          "p50 us", "p99 us"))
+            stats = self.stats(cursor)
+            for name in sorted(stats, key=lambda name: -stats[name][1]):
+                calls, total, p50, p99 = stats[name]
+                lines.append("  %-30s %9d %11.3f %10.2f %10.2f %10.2f" %
+                             (name, calls, total * 1e3, total / calls * 1e6,
+                              p50 * 1e6, p99 * 1e6))
+        return "\n".join(lines) + "\n"
+
+
+def handle_address(handle):
+    """The address of a dbcapi handle, held as an integer or a pointer,
+    or None for other arguments."""
+    if isinstance(handle, int):
+        return handle
+    try:
+        return cast(handle, c_void_p).value
+    except Exception:
+        return None
+
+
+def percentile(histogram, calls, fraction):
+    """The time in seconds under which fraction of the calls counted in
+    histogram took, taking the middle of its bucket."""
+    rank = fraction * calls
+    seen = 0
+    for bucket in sorted(histogram):
+        seen += histogram[bucket]
+        if seen >= rank:
+            return 2 ** ((bucket + 0.5) / PROFILE_BUCKETS) / 1e9
+    return 0.0
+
+
+def profile(file=None):
+    """Return a Profile of the dbcapi calls made in a with block, which
+    writes a table of them to file, sys.stderr by default, at its end."""
+    return Profile(file)
+
+
+HOOK_EVENTS = frozenset(['on_prepare', 'on_execute', 'on_fetch_batch',
+                         'on_commit', 'on_error'])
+
+class Hooks(object):
+    """Callbacks for the events of a connection or cursor.  Each is called
+    with a dict describing the event; see add_hook()."""
+
+    hooks = {}
+
+    def add_hook(self, event, callback):
+        """Call callback(info) on each event, one of HOOK_EVENTS.  info
+        always holds 'event' and 'connection', and for cursor events
+        'cursor' and 'operation', the SQL text.  Hooks added to a
+        connection also see the events of its cursors.
+
+        on_prepare: 'server_time' taken to prepare the statement, and
+            'cached', true if it was reused from the statement cache.
+        on_execute: 'elapsed' time of the execute call, 'server_time'
+            spent executing in dbcapi, the 'rows' affected, and
+            'cached', true if the result set came from the result cache.
+        on_fetch_batch: 'elapsed', 'server_time' spent fetching and
+            'decode_time' spent decoding a block of 'rows' rows, whose
+            string and binary values hold 'bytes' bytes (None if not
+            counted).
+        on_commit: 'server_time'.
+        on_error: 'errorclass', 'errortext' and 'sqlcode', before the
+            error is handled."""
+        if event not in HOOK_EVENTS:
+            raise ValueError("unknown hook event %r" % (event,))
+        hooks = dict(self.hooks)
+        hooks[event] = hooks.get(event, ()) + (callback,)
+        self.hooks = hooks
+
+    def remove_hook(self, event, callback):
+        hooks = dict(self.hooks)
+        callbacks = list(hooks.get(event, ()))
+        callbacks.remove(callback)
+        hooks[event] = tuple(callbacks)
+        self.hooks = hooks
+
+
+def value_bytes(rows):
+    """The total length of the string and binary values in rows."""
+    return sum(len(value) for row in rows for value in row
+               if isinstance(value, (bytes, str, bytearray, memoryview,
+                                     ColumnReader)))
+
+
+# connection parameters left out of the key a character set is remembered
+# under, so that passwords are not kept
+CREDENTIALS = frozenset(['pwd', 'password', 'enp', 'encryptedpassword'])
+
+# the number of character sets remembered for later connections
+CHAR_SETS_SIZE = 64
+
+def char_set_key(kwargs):
+    return tuple(sorted((kw.lower(), arg) for kw, arg in kwargs.items()
+                        if kw.lower() not in CREDENTIALS))
+
+
+class Connection(Hooks):
 
     # cache the api object so we don't have to load and unload every single time
     cls_parent = None
 
+    # the character set of each set of connection parameters, less
+    # credentials, that has connected, so later connections with them need
+    # not ask the server; guarded by root_lock
+    char_sets = OrderedDict()
+
     def __init__(self, args, kwargs, parent = None):
 
         # make it so we don't load Root() and therefore the
@@ -578,10 +1769,11 @@ class Connection(object):
         if parent == None:
 
             # cache the Root() object so we don't load it every time
-            if Connection.cls_parent == None:
-                parent = Connection.cls_parent = Root("PYTHON")
-            else:
-                parent = Connection.cls_parent
+            with root_lock:
+                if Connection.cls_parent == None:
+                    parent = Connection.cls_parent = Root("PYTHON")
+                else:
+                    parent = Connection.cls_parent
 
         self.Error = Error
         self.Warning = Warning
@@ -598,33 +1790,71 @@ class Connection(object):
         self.messages = []
 
         self.cursors = set()
+        # guards the set of cursors; making a cursor does not wait for
+        # the statement another thread is running
+        self.cursors_lock = threading.Lock()
+
+        # held by each thread for the dbcapi calls it makes on the
+        # connection, up to and including reading their errors
+        self.lock = threading.RLock()
+
+        # options for the driver itself, rather than connection parameters
+        kwargs = dict(kwargs)
+        statement_cache_size = int(kwargs.pop('statement_cache_size', 0))
+        declared_char_set = kwargs.pop('char_set', None)
+        if declared_char_set == 'iso_1':
+            declared_char_set = 'iso-8859-1'
+        if declared_char_set is not None:
+            # an unknown codec fails before connecting
+            codecs.lookup(declared_char_set)
+        self.query_timeout = kwargs.pop('query_timeout', None)
+        self.result_cache = kwargs.pop('result_cache', None)
+        result_cache_size = int(kwargs.pop('result_cache_size', 0))
+        result_cache_ttl = float(kwargs.pop('result_cache_ttl',
+                                            RESULT_CACHE_TTL))
+        if self.result_cache is None and result_cache_size > 0:
+            self.result_cache = ResultCache(result_cache_size,
+                                            result_cache_ttl)
+        # the tables written in the current transaction, whose results
+        # are not cached until it ends
+        self.uncommitted = set()
 
         self.parent, self.api = parent, parent.api
+        self.api_version = parent.api_version
+        self.DataValue = parent.DataValue
+        self.BindParam = parent.BindParam
+        self.ColumnInfo = parent.ColumnInfo
+        self.statement_cache = StatementCache(self.api, statement_cache_size)
         self.c = self.api.sqlany_new_connection();
         params = ';'.join(kw+'='+arg for kw, arg in v3list(list(kwargs.items())))
+        key = char_set_key(kwargs)
         char_set = 'utf-8'
         if isinstance(params, str):
             params = params.encode(char_set)
         if self.api.sqlany_connect(self.c, params):
-            self.valueof = mk_valueof((A_BINARY, A_STRING), char_set)
-            self.assign = mk_assign(char_set)
-            self.char_set = char_set
-            cur = self.cursor()
             try:
-                cur.execute("select connection_property('CharSet')")
-                char_set = cur.fetchone()[0]
-                if isinstance(char_set, bytes):
-                    char_set = char_set.decode()
-                    # iso_1 means iso-8859-1 in sql anywhere
-                    # details see: http://infocenter.sybase.com/help/index.jsp?topic=/com.sybase.help.sqlanywhere.12.0.1/dbadmin/determining-locale-natlang.html
-                    if(char_set=='iso_1'):
-                        char_set = 'iso-8859-1'
+                self.set_char_set(char_set, (A_BINARY, A_STRING))
+                with root_lock:
+                    char_set = (declared_char_set or
+                                Connection.char_sets.get(key))
+                if char_set is None:
+                    char_set = self.server_char_set()
+                # iso_1 means iso-8859-1 in sql anywhere
+                # details see: http://infocenter.sybase.com/help/index.jsp?topic=/com.sybase.help.sqlanywhere.12.0.1/dbadmin/determining-locale-natlang.html
+                if(char_set=='iso_1'):
+                    char_set = 'iso-8859-1'
                 if codecs.lookup(char_set):
-                    self.valueof = mk_valueof((A_BINARY,), char_set)
-                    self.assign = mk_assign(char_set)
-                    self.char_set = char_set
-            finally:
-                cur.close()
+                    self.set_char_set(char_set, (A_BINARY,))
+                    if declared_char_set is None:
+                        with root_lock:
+                            Connection.char_sets[key] = char_set
+                            if len(Connection.char_sets) > CHAR_SETS_SIZE:
+                                Connection.char_sets.popitem(last=False)
+            except:
+                self.api.sqlany_disconnect(self.c)
+                self.api.sqlany_free_connection(self.c)
+                self.c = None
+                raise
             parent.add_conn(self)
         else:
             error = self.error()
@@ -640,9 +1870,35 @@ class Connection(object):
 
     def handleerror(self, errorclass, errorvalue, sqlcode):
         if errorclass:
+            if self.hooks and errorclass is not Warning:
+                self.fire('on_error', errorclass=errorclass,
+                          errortext=errorvalue, sqlcode=sqlcode)
             eh = self.errorhandler or standardErrorHandler
             eh(self, None, errorclass, errorvalue, sqlcode)
 
+    def fire(self, event, **info):
+        info['event'] = event
+        info['connection'] = self
+        for hook in self.hooks.get(event, ()):
+            hook(info)
+
+    def set_char_set(self, char_set, raw_types):
+        self.raw_types = raw_types
+        self.valueof = mk_valueof(raw_types, char_set)
+        self.assign_batch = mk_assign_batch(char_set)
+        self.char_set = char_set
+
+    def server_char_set(self):
+        cur = self.cursor()
+        try:
+            cur.execute("select connection_property('CharSet')", cache_ttl=0)
+            char_set = cur.fetchone()[0]
+        finally:
+            cur.close()
+        if isinstance(char_set, bytes):
+            char_set = char_set.decode()
+        return char_set
+
     def con(self):
         if not self.c:
             self.handleerror(InterfaceError, "not connected", -101)
@@ -650,55 +1906,88 @@ class Connection(object):
 
     def commit(self):
         self.messages = []
-        return self.api.sqlany_commit(self.con())
+        if not self.hooks:
+            with self.lock:
+                result = self.api.sqlany_commit(self.con())
+        else:
+            start = clock()
+            with self.lock:
+                result = self.api.sqlany_commit(self.con())
+            self.fire('on_commit', server_time=clock() - start)
+        self.end_transaction()
+        return result
 
     def rollback(self):
         self.messages = []
-        return self.api.sqlany_rollback(self.con())
+        with self.lock:
+            result = self.api.sqlany_rollback(self.con())
+        self.end_transaction()
+        return result
+
+    def wrote(self, tables):
+        """Drop the cached results of tables a statement is about to write
+        to, and cache none of theirs until the transaction ends."""
+        self.uncommitted.update(tables)
+        self.result_cache.invalidate(*tables)
+
+    def end_transaction(self):
+        # results cached during the transaction, by other connections
+        # sharing the cache, are from before its writes
+        if self.uncommitted:
+            tables, self.uncommitted = self.uncommitted, set()
+            self.result_cache.invalidate(*tables)
 
     def cancel(self):
+        # not locked, since it interrupts the call another thread is making
         self.messages = []
         try:
             return self.api.sqlany_cancel(self.con())
         except AttributeError:
             self.handleerror(InterfaceError, "cancel not supported", -1965)
 
-    def mk_error():
+    def error(self):
         buf = create_string_buffer(256)
-        buf_size = sizeof(buf)
-        def error(self):
-            rc = self.api.sqlany_error(self.con(), buf, buf_size)
-            if rc == 0:
-                return (None, None, 0)
-            elif rc > 0:
-                return (Warning, buf.value, rc)
-            elif rc in (-193,-194,-195,-196):
-                return (IntegrityError, buf.value, rc)
-            else:
-                return (OperationalError, buf.value, rc)
-        return error
-
-    error = mk_error()
+        with self.lock:
+            rc = self.api.sqlany_error(self.con(), buf, sizeof(buf))
+        if rc == 0:
+            return (None, None, 0)
+        elif rc > 0:
+            return (Warning, buf.value, rc)
+        elif rc in (-193,-194,-195,-196):
+            return (IntegrityError, buf.value, rc)
+        else:
+            return (OperationalError, buf.value, rc)
 
     def clear_error(self):
-        return self.api.sqlany_clear_error(self.con())
+        with self.lock:
+            return self.api.sqlany_clear_error(self.con())
 
     def close(self):
         self.messages = []
         c = self.con()
-        if self.c != None:
-            for x in self.cursors:
-                x.close(remove=False)
-            self.cursors = None
-            self.api.sqlany_disconnect(c)
-            self.api.sqlany_free_connection(c)
-            self.parent.remove_conn(self)
-            self.c = None
+        # background fetches need the lock to finish
+        with self.cursors_lock:
+            cursors = list(self.cursors or ())
+        for x in cursors:
+            x.settle()
+        with self.lock:
+            if self.c != None:
+                with self.cursors_lock:
+                    cursors, self.cursors = self.cursors, None
+                for x in cursors:
+                    x.close(remove=False)
+                self.statement_cache.clear()
+                self.api.sqlany_disconnect(c)
+                self.api.sqlany_free_connection(c)
+                self.parent.remove_conn(self)
+                self.c = None
+                self.end_transaction()
 
     def cursor(self):
         self.messages = []
         x = Cursor(self)
-        self.cursors.add(x)
+        with self.cursors_lock:
+            self.cursors.add(x)
         return x
 
     def __enter__(self): return self.cursor()
@@ -709,32 +1998,696 @@ class Connection(object):
         else:
             self.commit()
 
-class Cursor(object):
-    class TypeConverter(object):
-        def __init__(self,types):
-            def find_converter(t):
-                return CONVERSION_CALLBACKS.get(t, lambda x: x)
-            self.converters = v3list(list(map(find_converter, types)))
+class ColumnReader(io.RawIOBase):
+    """A read-only, seekable file over one value of the row most recently
+    fetched by a cursor.  The value is read in pieces with sqlany_get_data
+    rather than fetched whole, so reading it in chunks takes constant
+    memory.  The reader is only valid until the cursor fetches another
+    row or executes another statement."""
+
+    def __init__(self, cursor, column, chunk_size):
+        io.RawIOBase.__init__(self)
+        self.cursor = cursor
+        self.column = column
+        self.chunk_size = chunk_size
+        self.fetches = cursor.fetches
+        self.offset = 0
+        info = DataInfo()
+        with cursor.lock:
+            if not cursor.api.sqlany_get_data_info(cursor.get_stmt(), column,
+                                                   byref(info)):
+                cursor.handleerror(*cursor.parent.error())
+                cursor.handleerror(InterfaceError, "no current row", -853)
+        self.type = info.type
+        self.is_null = bool(info.is_null)
+        self.size = info.data_size
+
+    def __len__(self):
+        return self.size
+
+    def get_stmt(self):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        cursor = self.cursor
+        if cursor.parent is None or cursor.fetches != self.fetches:
+            cursor.handleerror(InterfaceError,
+                               "column reader is no longer valid", -853)
+        return cursor.get_stmt()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.offset
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.offset
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position %d" % offset)
+        self.offset = offset
+        return offset
+
+    def readinto(self, b):
+        stmt = self.get_stmt()
+        view = memoryview(b)
+        size = min(len(view) * view.itemsize,
+                   max(self.size - self.offset, 0))
+        if size == 0:
+            return 0
+        buffer = (c_char * size).from_buffer(view)
+        with self.cursor.lock:
+            n = self.cursor.api.sqlany_get_data(stmt, self.column,
+                                                self.offset, buffer, size)
+            if n < 0:
+                self.cursor.handleerror(*self.cursor.parent.error())
+                return 0
+        self.offset += n
+        return n
+
+    def readall(self):
+        b = bytearray(max(self.size - self.offset, 0))
+        n = self.readinto(b)
+        del b[n:]
+        return bytes(b)
+
+    def chunks(self):
+        """Yield the rest of the value in pieces of chunk_size bytes."""
+        buffer = bytearray(self.chunk_size)
+        view = memoryview(buffer)
+        while True:
+            n = self.readinto(buffer)
+            if not n:
+                return
+            yield view[:n].tobytes()
+
+
+# The Arrow C data interface, used by Cursor.fetch_arrow_batches()
+
+ARROW_FLAG_NULLABLE = 2
+
+# Arrow formats and struct formats of the fixed size A_* types
+ARROW_FORMATS = {A_DOUBLE: (b'g', 'd'),
+                 A_VAL64:  (b'l', 'q'), A_UVAL64: (b'L', 'Q'),
+                 A_VAL32:  (b'i', 'i'), A_UVAL32: (b'I', 'I'),
+                 A_VAL16:  (b's', 'h'), A_UVAL16: (b'S', 'H'),
+                 A_VAL8:   (b'c', 'b'), A_UVAL8:  (b'C', 'B')}
+
+# Rows per record batch, unless given to Cursor.fetch_arrow_batches()
+ARROW_BATCH_ROWS = 1 << 16
+
+
+class ArrowSchema(Structure):
+    """Must match struct ArrowSchema."""
+
+ReleaseSchema = CFUNCTYPE(None, POINTER(ArrowSchema))
+ArrowSchema._fields_ = [("format",       c_char_p),
+                        ("name",         c_char_p),
+                        ("metadata",     c_char_p),
+                        ("flags",        c_int64),
+                        ("n_children",   c_int64),
+                        ("children",     POINTER(POINTER(ArrowSchema))),
+                        ("dictionary",   POINTER(ArrowSchema)),
+                        ("release",      ReleaseSchema),
+                        ("private_data", c_void_p)]
+
+
+class ArrowArray(Structure):
+    """Must match struct ArrowArray."""
+
+ReleaseArray = CFUNCTYPE(None, POINTER(ArrowArray))
+ArrowArray._fields_ = [("length",       c_int64),
+                       ("null_count",   c_int64),
+                       ("offset",       c_int64),
+                       ("n_buffers",    c_int64),
+                       ("n_children",   c_int64),
+                       ("buffers",      POINTER(c_void_p)),
+                       ("children",     POINTER(POINTER(ArrowArray))),
+                       ("dictionary",   POINTER(ArrowArray)),
+                       ("release",      ReleaseArray),
+                       ("private_data", c_void_p)]
+
+
+class ArrowArrayStream(Structure):
+    """Must match struct ArrowArrayStream."""
+
+GetSchema = CFUNCTYPE(c_int, POINTER(ArrowArrayStream), POINTER(ArrowSchema))
+GetNext = CFUNCTYPE(c_int, POINTER(ArrowArrayStream), POINTER(ArrowArray))
+GetLastError = CFUNCTYPE(c_void_p, POINTER(ArrowArrayStream))
+ReleaseStream = CFUNCTYPE(None, POINTER(ArrowArrayStream))
+ArrowArrayStream._fields_ = [("get_schema",     GetSchema),
+                             ("get_next",       GetNext),
+                             ("get_last_error", GetLastError),
+                             ("release",        ReleaseStream),
+                             ("private_data",   c_void_p)]
+
+# What the exported structs point to, keyed by their private_data, until
+# the consumer releases them.  The structs may be moved by the consumer,
+# so they are only ever found through private_data.
+arrow_exports = {}
+arrow_keys = itertools.count(1)
+
+# The streams handed out in capsules, keyed by address
+arrow_capsules = {}
+
+ARROW_STREAM_NAME = b'arrow_array_stream'
+PyCapsule_New = PYFUNCTYPE(py_object, c_void_p, c_char_p, c_void_p)(
+    ("PyCapsule_New", pythonapi))
+PyCapsule_GetPointer = PYFUNCTYPE(c_void_p, c_void_p, c_char_p)(
+    ("PyCapsule_GetPointer", pythonapi))
+
+
+def arrow_format(a_type, native_type):
+    """Return the Arrow format of a column, and the struct format of its
+    values if they have a fixed size.  Columns with a converter, and
+    dates, times and decimals, which dbcapi returns as strings, are
+    exported as strings."""
+    if native_type in CONVERSION_CALLBACKS:
+        return b'u', None
+    if native_type == DT_BIT:
+        return b'b', None
+    if a_type in ARROW_FORMATS:
+        return ARROW_FORMATS[a_type]
+    if a_type == A_BINARY:
+        return b'z', None
+    return b'u', None
+
+
+def pack_bits(flags):
+    """Pack a sequence of 0 and 1 values into an Arrow bitmap, least
+    significant bit first.  Multiplying eight 0 or 1 bytes by the magic
+    number gathers them into the top byte of the product."""
+    bits = bytearray(flags)
+    bits.extend(b'\0' * (-len(bits) % 8))
+    words = unpack('<%dQ' % (len(bits) // 8), bytes(bits))
+    return bytes(bytearray((word * 0x0102040810204080 &
+                            0xffffffffffffffff) >> 56 for word in words))
+
+
+def arrow_buffers(fmt, struct_fmt, parts):
+    """Join the parts of a column into the buffers of an Arrow array, and
+    return them with the number of NULLs.  A part is a list of values, or
+    for a wide fetch of a fixed size type, its (data, null flags)."""
+    nulls = [part[1] if isinstance(part, tuple) else
+             [value is None for value in part] for part in parts]
+    null_count = sum(sum(flags) for flags in nulls)
+    validity = None
+    if null_count:
+        validity = pack_bits([0 if null else 1
+                              for flags in nulls for null in flags])
+    if struct_fmt is not None:
+        data = []
+        for part in parts:
+            if isinstance(part, tuple):
+                data.append(part[0])
+            else:
+                data.append(pack('=%d%s' % (len(part), struct_fmt),
+                                 *[0 if value is None else value
+                                   for value in part]))
+        return [validity, b''.join(data)], null_count
+    if fmt == b'b':
+        return [validity, pack_bits([1 if value else 0
+                                     for part in parts
+                                     for value in part])], null_count
+    values = [b'' if value is None else
+              value if isinstance(value, bytes) else
+              value.encode('utf-8') if isinstance(value, str) else
+              str(value).encode('utf-8')
+              for part in parts for value in part]
+    offsets = [0]
+    offset = 0
+    for value in values:
+        offset += len(value)
+        offsets.append(offset)
+    return ([validity, pack('=%di' % len(offsets), *offsets),
+             b''.join(values)], null_count)
+
+
+@ReleaseSchema
+def release_child_schema(schema):
+    schema.contents.release = ReleaseSchema()
+
+
+@ReleaseSchema
+def release_schema(schema):
+    schema = schema.contents
+    for i in range(schema.n_children):
+        child = schema.children[i].contents
+        if child.release:
+            child.release = ReleaseSchema()
+    arrow_exports.pop(schema.private_data, None)
+    schema.release = ReleaseSchema()
+
+
+@ReleaseArray
+def release_child_array(array):
+    array.contents.release = ReleaseArray()
+
+
+@ReleaseArray
+def release_array(array):
+    array = array.contents
+    for i in range(array.n_children):
+        child = array.children[i].contents
+        if child.release:
+            child.release = ReleaseArray()
+    arrow_exports.pop(array.private_data, None)
+    array.release = ReleaseArray()
+
+
+def export_schema(out, formats, names):
+    """Fill in out as the schema of a record batch: a struct with a
+    nullable field for each column."""
+    children = [ArrowSchema(format=fmt, name=name, flags=ARROW_FLAG_NULLABLE,
+                            release=release_child_schema)
+                for fmt, name in zip(formats, names)]
+    pointers = (POINTER(ArrowSchema) * len(children))(
+        *[pointer(child) for child in children])
+    key = next(arrow_keys)
+    arrow_exports[key] = (children, pointers, formats, names)
+    out.format = b'+s'
+    out.name = None
+    out.metadata = None
+    out.flags = 0
+    out.n_children = len(children)
+    out.children = pointers
+    out.dictionary = None
+    out.private_data = key
+    out.release = release_schema
+
+
+def export_batch(out, columns, length):
+    """Fill in out as a record batch of length rows, from the buffers and
+    NULL count of each column."""
+    children, keep = [], []
+    for buffers, null_count in columns:
+        addresses = (c_void_p * len(buffers))(
+            *[None if buffer is None else
+              cast(c_char_p(buffer), c_void_p).value for buffer in buffers])
+        children.append(ArrowArray(length=length, null_count=null_count,
+                                   n_buffers=len(buffers), buffers=addresses,
+                                   release=release_child_array))
+        keep.append((addresses, buffers))
+    pointers = (POINTER(ArrowArray) * len(children))(
+        *[pointer(child) for child in children])
+    validity = (c_void_p * 1)()
+    key = next(arrow_keys)
+    arrow_exports[key] = (children, pointers, validity, keep)
+    out.length = length
+    out.null_count = 0
+    out.offset = 0
+    out.n_buffers = 1
+    out.n_children = len(children)
+    out.buffers = validity
+    out.children = pointers
+    out.dictionary = None
+    out.private_data = key
+    out.release = release_array
+
+
+@GetSchema
+def arrow_get_schema(stream, out):
+    batches = arrow_exports[stream.contents.private_data]
+    try:
+        export_schema(out.contents, batches.formats, batches.names)
+    except Exception as e:
+        return batches.failed(e)
+    return 0
+
+
+@GetNext
+def arrow_get_next(stream, out):
+    batches = arrow_exports[stream.contents.private_data]
+    try:
+        batch = batches.next_batch()
+        if batch is None:
+            out.contents.release = ReleaseArray()
+        else:
+            export_batch(out.contents, *batch)
+    except Exception as e:
+        return batches.failed(e)
+    return 0
+
+
+@GetLastError
+def arrow_get_last_error(stream):
+    batches = arrow_exports[stream.contents.private_data]
+    if batches.error is None:
+        return None
+    return addressof(batches.error)
+
+
+@ReleaseStream
+def arrow_release_stream(stream):
+    stream = stream.contents
+    arrow_exports.pop(stream.private_data, None)
+    stream.release = ReleaseStream()
+
+
+@CFUNCTYPE(None, c_void_p)
+def arrow_capsule_destructor(capsule):
+    address = PyCapsule_GetPointer(capsule, ARROW_STREAM_NAME)
+    stream = arrow_capsules.pop(address, None)
+    if stream is not None and stream.release:
+        stream.release(pointer(stream))
+
+
+class ArrowBatches(object):
+    """The rest of a result set as a stream of Arrow record batches, for
+    any consumer of the Arrow PyCapsule interface, such as pyarrow, polars
+    or DuckDB.  The batches are fetched as the consumer asks for them."""
+
+    def __init__(self, cursor, batch_rows):
+        self.cursor = cursor
+        self.batch_rows = batch_rows
+        self.names = [column[0].encode('utf-8')
+                      for column in cursor.description]
+        self.formats, self.struct_formats = zip(
+            *[arrow_format(a_type, native_type)
+              for a_type, native_type in cursor.column_types])
+        self.error = None
+
+    def __arrow_c_stream__(self, requested_schema=None):
+        """Export the batches as an ArrowArrayStream in a capsule.  A
+        requested schema is ignored, as the columns are not cast."""
+        key = next(arrow_keys)
+        arrow_exports[key] = self
+        stream = ArrowArrayStream(get_schema=arrow_get_schema,
+                                  get_next=arrow_get_next,
+                                  get_last_error=arrow_get_last_error,
+                                  release=arrow_release_stream,
+                                  private_data=key)
+        arrow_capsules[addressof(stream)] = stream
+        return PyCapsule_New(addressof(stream), ARROW_STREAM_NAME,
+                             cast(arrow_capsule_destructor, c_void_p))
+
+    def failed(self, e):
+        self.error = create_string_buffer(str(e).encode('utf-8', 'replace'))
+        return errno.EIO
+
+    def next_batch(self):
+        """Fetch the next batch, and return the buffers of each column and
+        the number of rows, or None at the end of the result set."""
+        cursor = self.cursor
+        parts = [[] for fmt in self.formats]
+        length = 0
+        for block in cursor.blocks(self.batch_rows):
+            if isinstance(block, list):
+                n = len(block)
+                for column, values in zip(parts, zip(*block)):
+                    column.append(list(values))
+            else:
+                n = block
+                for j, (buffer, nulls, read) in enumerate(
+                        cursor.rowset_columns):
+                    struct_fmt = self.struct_formats[j]
+                    if struct_fmt is None:
+                        parts[j].append(list(cursor.bound_values(j, n)))
+                    else:
+                        parts[j].append((buffer[:n * calcsize(struct_fmt)],
+                                         nulls[:n]))
+            length += n
+        if not length:
+            return None
+        return ([arrow_buffers(fmt, struct_fmt, column)
+                 for fmt, struct_fmt, column
+                 in zip(self.formats, self.struct_formats, parts)], length)
+
+
+# the number of row offsets a SpooledResult reads at a time when iterated
+SPOOL_OFFSETS = 4096
+
+class SpooledResult(object):
+    """The rows of a result set, as a read-only sequence.  Rows are kept
+    in memory until they come to more than max_memory bytes, by an
+    estimate, and the rest are written to a temporary file, which is
+    memory-mapped once they have all been fetched.  Each row in the file
+    is marshalled, or pickled if it holds values marshal cannot write,
+    and the offsets of the rows are kept in a second file, so indexing
+    reads just the row asked for.  close() deletes the files."""
+
+    def __init__(self, max_memory):
+        self.max_memory = max_memory
+        self.rows = []
+        self.size = 0
+        self.data = self.index = None
+        self.data_map = self.index_map = None
+        # the rows written to the file, and its length
+        self.count = 0
+        self.position = 0
+
+    def __len__(self):
+        return len(self.rows) + self.count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[k] for k in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("row index out of range")
+        k = i - len(self.rows)
+        if k < 0:
+            return self.rows[i]
+        start, end = unpack_from('2q', self.index_map, 8 * k)
+        return load_row(self.data_map[start:end])
+
+    def __iter__(self):
+        for row in self.rows:
+            yield row
+        for k in range(0, self.count, SPOOL_OFFSETS):
+            n = min(SPOOL_OFFSETS, self.count - k)
+            offsets = unpack_from('%dq' % (n + 1), self.index_map, 8 * k)
+            data = self.data_map
+            for j in range(n):
+                yield load_row(data[offsets[j]:offsets[j + 1]])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc, value, tb):
+        self.close()
+
+    def spilled(self):
+        """Return whether any rows have been written to the file."""
+        return self.data is not None
+
+    def extend(self, rows):
+        if self.data is None:
+            self.size += value_bytes(rows) + VALUE_BYTES * sum(map(len, rows))
+            if self.size <= self.max_memory:
+                self.rows.extend(rows)
+                return
+            import tempfile
+            self.data = tempfile.TemporaryFile()
+            self.index = tempfile.TemporaryFile()
+        offsets = []
+        records = []
+        position = self.position
+        for row in rows:
+            record = dump_row(row)
+            offsets.append(position)
+            records.append(record)
+            position += len(record)
+        self.data.write(b''.join(records))
+        self.index.write(pack('%dq' % len(offsets), *offsets))
+        self.position = position
+        self.count += len(rows)
+
+    def finish(self):
+        """Map the file once all the rows have been written."""
+        if self.data is None:
+            return
+        import mmap
+        # the end of the last row
+        self.index.write(pack('q', self.position))
+        self.data.flush()
+        self.index.flush()
+        self.data_map = mmap.mmap(self.data.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        self.index_map = mmap.mmap(self.index.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
 
-        def gen(self,values):
-            for converter, value in zip(self.converters, values):
-                yield converter(value)
+    def close(self):
+        for f in (self.data_map, self.index_map, self.data, self.index):
+            if f is not None:
+                f.close()
+        self.data = self.index = None
+        self.data_map = self.index_map = None
+        self.rows = []
+        self.count = 0
+
+def dump_row(row):
+    try:
+        return b'm' + marshal.dumps(row)
+    except ValueError:
+        import pickle
+        return b'p' + pickle.dumps(row, pickle.HIGHEST_PROTOCOL)
+
+def load_row(record):
+    if record[:1] == b'm':
+        return marshal.loads(record[1:])
+    import pickle
+    return pickle.loads(record[1:])
+
+
+def clock():
+    return getattr(time, 'monotonic', time.time)()
+
+
+class Watchdog(object):
+    """The thread, shared by all connections, that cancels statements
+    running past their deadline.  It is started when first needed."""
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        # [deadline, sequence, connection, cancelled], soonest first
+        self.deadlines = []
+        self.unwatched = 0
+        self.sequence = itertools.count()
+        self.thread = None
+
+    def watch(self, connection, timeout):
+        """Cancel the statement running on connection in timeout seconds,
+        unless unwatch() is called first."""
+        entry = [clock() + timeout, next(self.sequence), connection, False]
+        with self.lock:
+            heapq.heappush(self.deadlines, entry)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            elif self.deadlines[0] is entry:
+                # the thread is waiting for a later deadline
+                self.lock.notify()
+        return entry
+
+    def unwatch(self, entry):
+        """Stop watching entry.  Once this returns it will not be
+        cancelled; returns whether it already has been."""
+        with self.lock:
+            if entry[2] is not None:
+                entry[2] = None
+                self.unwatched += 1
+                if self.unwatched > max(64, len(self.deadlines) // 2):
+                    self.deadlines = [e for e in self.deadlines
+                                      if e[2] is not None]
+                    heapq.heapify(self.deadlines)
+                    self.unwatched = 0
+            return entry[3]
+
+    def run(self):
+        with self.lock:
+            while True:
+                while self.deadlines and self.deadlines[0][2] is None:
+                    heapq.heappop(self.deadlines)
+                    self.unwatched -= 1
+                if not self.deadlines:
+                    self.lock.wait()
+                    continue
+                remaining = self.deadlines[0][0] - clock()
+                if remaining > 0:
+                    self.lock.wait(remaining)
+                    continue
+                entry = heapq.heappop(self.deadlines)
+                connection, entry[2], entry[3] = entry[2], None, True
+                try:
+                    if connection.c:
+                        connection.api.sqlany_cancel(connection.c)
+                except Exception:
+                    pass
+
+watchdog = Watchdog()
 
+
+def run_worker(requests, results):
+    """Make the calls put on requests in turn, putting a (result, error)
+    pair for each on results, until a None request arrives."""
+    while True:
+        call = requests.get()
+        if call is None:
+            return
+        try:
+            results.put((call(), None))
+        except BaseException as e:
+            results.put((None, e))
+
+
+class Cursor(Hooks):
     def __init__(self, parent):
         self.messages = []
         self.parent, self.api = parent, parent.api
+        self.lock = parent.lock
         self.valueof = self.parent.valueof
-        self.assign = self.parent.assign
+        self.assign_batch = self.parent.assign_batch
         self.char_set = self.parent.char_set
+        self.raw_types = self.parent.raw_types
         self.errorhandler = self.parent.errorhandler
         self.arraysize = 1
-        self.converter = None
+        self.rowset_size = ROWSET_SIZE
+        self.binary_views = False
+        # return long values as ColumnReaders instead of fetching them
+        self.stream_long_columns = False
+        self.collect_warnings = False
+        self.background_prefetch = False
+        self.background = False
+        self.worker = None
+        self.pending = False
+        self.rowsets = None
+        self.rowset_index = 0
+        self.decoder = None
+        self.rowset = None
+        self.rowset_columns = None
+        self.column_types = None
+        self.buffered = deque()
+        self.prefetch = 1
         self.rowcount = -1
         self.__stmt = None
+        self.binder = None
+        self.inputsizes = None
+        self.outputsizes = {}
+        self.fetches = 0
+        self.number = next(cursor_numbers)
+        self.operation = None
         self.description = None
+        # whether the result set is one taken from the result cache
+        self.cached = False
+        self.watch = None
+        # time spent in dbcapi, while an instrumented call adds it up
+        self.server_time = None
+
+    def hooked(self):
+        return bool(self.hooks or self.parent is not None and
+                    self.parent.hooks)
+
+    def fire(self, event, **info):
+        parent = self.parent
+        operation = self.operation
+        if isinstance(operation, bytes):
+            operation = operation.decode(self.char_set, 'replace')
+        info['event'] = event
+        info['connection'] = parent
+        info['cursor'] = self
+        info['operation'] = operation
+        hooks = self.hooks.get(event, ())
+        if parent is not None:
+            hooks += parent.hooks.get(event, ())
+        for hook in hooks:
+            hook(info)
 
     def handleerror(self, errorclass, errorvalue, sqlcode):
         if errorclass:
+            if (self.watch is not None and self.watch[3] and
+                    errorclass is not Warning):
+                errorclass = QueryTimeoutError
+            if errorclass is not Warning and self.hooked():
+                self.fire('on_error', errorclass=errorclass,
+                          errortext=errorvalue, sqlcode=sqlcode)
             eh = self.errorhandler or standardErrorHandler
             eh(self.parent, self, errorclass, errorvalue, sqlcode)
 
@@ -763,26 +2716,63 @@ class Cursor(object):
 
     def new_statement(self, operation):
         self.free_statement()
-        self.stmt = self.api.sqlany_prepare(self.con(), operation)
+        hooked = self.hooked()
+        if hooked:
+            start = clock()
+        stmt, binder = self.parent.statement_cache.get(operation)
+        cached = stmt is not None
+        if stmt is None:
+            stmt = self.api.sqlany_prepare(self.con(), operation)
+        self.stmt = stmt
+        self.binder = binder
+        self.operation = operation
+        if active_profile is not None and stmt:
+            active_profile.own(stmt, self)
+        if hooked:
+            self.fire('on_prepare', server_time=clock() - start,
+                      cached=cached)
 
     def free_statement(self):
+        self.settle()
         if self.__stmt:
-            self.api.sqlany_free_stmt(self.stmt)
+            if self.rowset is not None:
+                # the bound arrays are about to be released
+                self.api.sqlany_clear_column_bindings(self.stmt)
+                self.api.sqlany_set_rowset_size(self.stmt, 1)
+            self.parent.statement_cache.put(self.operation, self.stmt,
+                                            self.binder)
             self.stmt = None
+            self.binder = None
+            self.description = None
+            self.decoder = None
+            self.rowset = self.rowset_columns = None
+            self.rowsets = None
+            self.background = False
+            self.buffered.clear()
+            self.rowcount = -1
+            self.fetches += 1
+        elif self.cached:
+            self.cached = False
             self.description = None
-            self.converter = None
+            self.buffered.clear()
             self.rowcount = -1
 
     def close(self, remove=True):
         p = self.parent
         if p:
+            self.settle()
+            with self.lock:
+                if remove:
+                    with p.cursors_lock:
+                        p.cursors.remove(self)
+                self.free_statement()
+            if self.worker is not None:
+                self.worker[1].put(None)
+                self.worker = None
             self.parent = None
-            if remove:
-                p.cursors.remove(self)
-            self.free_statement()
 
     def columns(self):
-        info = ColumnInfo()
+        info = self.parent.ColumnInfo()
         for i in range(self.api.sqlany_num_cols(self.get_stmt())):
             self.api.sqlany_get_column_info(self.get_stmt(), i, byref(info))
             yield ((info.name.decode('utf-8'),
@@ -792,59 +2782,295 @@ class Cursor(object):
                    info.precision,
                    info.scale,
                    info.nullable),
-                   info.native_type)
-
-    def executemany(self, operation, seq_of_parameters):
+                   (info.type, info.native_type))
+
+    def describe(self):
+        """Describe the current result set, if any, and set up its decoding.
+        Returns the number of rows reported by dbcapi."""
+        self.settle()
+        self.buffered.clear()
+        self.fetches += 1
+        self.background = False
+        if self.rowset is not None:
+            self.api.sqlany_clear_column_bindings(self.stmt)
+            self.api.sqlany_set_rowset_size(self.stmt, 1)
+            self.rowset = self.rowset_columns = None
+            self.rowsets = None
+        try:
+            self.description, types = v3list(list(zip(*self.columns())))
+        except ValueError:
+            self.description = None
+            self.column_types = None
+            self.decoder = None
+            return self.api.sqlany_affected_rows(self.stmt)
+        self.column_types = types
+        streamed = ()
+        if self.stream_long_columns:
+            streamed = frozenset(i for i, (a_type, native_type)
+                                 in enumerate(types)
+                                 if native_type in LONG_TYPES)
+        self.decoder = mk_decoder(self.api, self.parent.DataValue, types,
+                                  self.raw_types, self.char_set,
+                                  self.binary_views, streamed)
+        # binary views and column readers are only valid until the next
+        # fetch, so they need rows to be fetched one at a time
+        self.prefetch = 1
+        if not self.binary_views and not streamed:
+            sizes = [column[3] for column in self.description]
+            if (self.parent.api_version >= API_VERSION_WIDE and
+                    self.rowset_size > 1):
+                rowset = mk_rowset(self.api, self.stmt,
+                                   self.parent.DataValue, types, sizes,
+                                   self.rowset_size, self.raw_types,
+                                   self.char_set)
+                if rowset is not None:
+                    self.rowset, self.rowset_columns = rowset[:2]
+                if rowset is not None and self.background_prefetch:
+                    # a second set of arrays for the worker to fetch into
+                    # while the first is decoded
+                    second = mk_rowset(self.api, self.stmt,
+                                       self.parent.DataValue, types, sizes,
+                                       self.rowset_size, self.raw_types,
+                                       self.char_set)
+                    if second is None:
+                        # fetch a row at a time instead, without the
+                        # first set's bindings, which would still fill
+                        # the arrays a rowset at a time
+                        self.api.sqlany_clear_column_bindings(self.stmt)
+                        self.api.sqlany_set_rowset_size(self.stmt, 1)
+                        self.rowset = self.rowset_columns = None
+                    else:
+                        self.rowsets = [rowset, second]
+                        self.rowset_index = 0
+            self.background = self.background_prefetch
+            width = max(1, sum(sizes))
+            self.prefetch = max(1, min(self.rowset_size,
+                                       ROWSET_BYTES // width))
+        return self.api.sqlany_num_rows(self.stmt)
+
+    def executebatch(self, rows, bind_count):
+        """Execute the prepared statement once for all of rows, with each
+        parameter bound to an array of its values.  Returns the number of
+        rows affected, or None if the rows could not be bound as arrays,
+        in which case nothing has been executed."""
+        if any(len(parameters) < bind_count for parameters in rows):
+            return None
+        if not self.api.sqlany_set_batch_size(self.stmt, len(rows)):
+            return None
+        try:
+            # the arrays replace the binder's own bindings
+            self.binder.invalidate()
+            arrays = []
+            for k in range(bind_count):
+                param = self.binder.describe(k)
+                bound = (self.assign_batch)(param,
+                                            [parameters[k] for parameters in rows])
+                if bound is None:
+                    return None
+                arrays.append(bound)
+                self.api.sqlany_bind_param(self.stmt, k, byref(param))
+            if not self.execute_stmt():
+                self.handleerror(*self.parent.error())
+            return self.describe()
+        finally:
+            self.api.sqlany_set_batch_size(self.stmt, 1)
+
+    def executemany(self, operation, seq_of_parameters, timeout=None):
+        """Execute operation for each of seq_of_parameters in turn.  If
+        timeout, or failing that the connection's query_timeout, is not
+        None, the statements are cancelled after that many seconds and
+        QueryTimeoutError is raised.  The first block of rows of a result
+        set is then fetched within the same timeout."""
         self.messages = []
+        if timeout is None:
+            timeout = self.parent.query_timeout
+        if self.parent.result_cache is not None:
+            kind, tables = self.parent.result_cache.parse(operation)[1:]
+            if kind == 'write':
+                self.parent.wrote(tables)
+        self.settle()
+        if self.hooked():
+            execute_rows = self.execute_timed
+        else:
+            execute_rows = self.execute_rows
+        with self.lock:
+            if timeout is None:
+                return execute_rows(operation, seq_of_parameters)
+            try:
+                self.api.sqlany_cancel
+            except AttributeError:
+                self.handleerror(InterfaceError, "cancel not supported", -1965)
+            # watched once the lock is held, so that it cancels nothing
+            # but this statement
+            self.watch = watchdog.watch(self.parent, timeout)
+            try:
+                result = execute_rows(operation, seq_of_parameters)
+                if self.description:
+                    # a query can do much of its work while its first rows
+                    # are fetched, so they are fetched under the watch too
+                    self.fill()
+                return result
+            finally:
+                watchdog.unwatch(self.watch)
+                self.watch = None
 
-        def bind(k, col):
-            param = BindParam()
-            self.api.sqlany_describe_bind_param(self.stmt, k, byref(param))
-            (self.assign)(param, col)
-            self.api.sqlany_bind_param(self.stmt, k, byref(param))
-            return param
+    def execute_stmt(self):
+        if self.server_time is None:
+            return self.api.sqlany_execute(self.stmt)
+        start = clock()
+        try:
+            return self.api.sqlany_execute(self.stmt)
+        finally:
+            self.server_time += clock() - start
+
+    def execute_timed(self, operation, seq_of_parameters):
+        start, self.server_time = clock(), 0.0
+        try:
+            result = self.execute_rows(operation, seq_of_parameters)
+        finally:
+            server_time, self.server_time = self.server_time, None
+        self.fire('on_execute', elapsed=clock() - start,
+                  server_time=server_time, rows=self.rowcount, cached=False)
+        return result
+
+    def execute_rows(self, operation, seq_of_parameters):
+        def execute(parameters):
+            parms = self.binder.bind(parameters)
+            if self.binder.streams and not self.binder.send(LOB_CHUNK_SIZE):
+                self.handleerror(*self.parent.error())
+            if not self.execute_stmt():
+                self.handleerror(*self.parent.error())
+            count(self.describe())
+            return parms
+
+        def count(rowcount):
+            if rowcount < 0:
+                # Can happen if number of rows is only an estimate
+                self.rowcount = -1
+            elif self.rowcount >= 0:
+                self.rowcount += rowcount
 
         try:
             if isinstance(operation, str):
                 operation = operation.encode(self.char_set)
             self.new_statement(operation)
-            bind_count = self.api.sqlany_num_params(self.stmt)
+            if self.binder is None:
+                self.binder = ParameterBinder(self.api, self.stmt,
+                                              self.parent.BindParam,
+                                              self.char_set)
+            self.binder.declare(self.inputsizes)
+            self.inputsizes = None
+            bind_count = len(self.binder)
             self.rowcount = 0
-            for parameters in seq_of_parameters:
-                parms = [bind(k, col)
-                         for k, col in enumerate(parameters[:bind_count])]
-                if not self.api.sqlany_execute(self.stmt):
-                    self.handleerror(*self.parent.error())
-
-                try:
-                    self.description, types = v3list(list(zip(*self.columns())))
-                    rowcount = self.api.sqlany_num_rows(self.stmt)
-                    self.converter = self.TypeConverter(types)
-                except ValueError:
-                    rowcount = self.api.sqlany_affected_rows(self.stmt)
-                    self.description = None
-                    self.converter = None
-
-                if rowcount < 0:
-                    # Can happen if number of rows is only an estimate
-                    self.rowcount = -1
-                elif self.rowcount >= 0:
-                    self.rowcount += rowcount
+            parms = []
+            # statements without a result set can be executed for many
+            # rows at once by binding arrays of parameters
+            if (bind_count and self.parent.api_version >= API_VERSION_WIDE
+                    and not self.api.sqlany_num_cols(self.stmt)):
+                for batch in batches(seq_of_parameters, bind_count):
+                    rowcount = None
+                    if len(batch) > 1:
+                        rowcount = self.executebatch(batch, bind_count)
+                    if rowcount is None:
+                        for parameters in batch:
+                            parms = execute(parameters)
+                    else:
+                        count(rowcount)
+            else:
+                for parameters in seq_of_parameters:
+                    parms = execute(parameters)
         except:
             self.rowcount = -1
             raise
 
-        return [(self.valueof)(param.value) for param in parms]
+        # streamed parameters were bound without a buffer, so have no value
+        return [(self.valueof)(param.value) if param.value.buffer else None
+                for param in parms]
+
+    def execute(self, operation, parameters = (), timeout=None,
+                cache_ttl=None):
+        """Execute operation with parameters.  If the connection has a
+        result cache, the result set of a query run with the same
+        parameters within the cache's ttl, or cache_ttl seconds if given,
+        is taken from the cache; a cache_ttl of 0 bypasses it."""
+        cache = self.parent.result_cache
+        if cache is None:
+            self.executemany(operation, [parameters], timeout)
+        else:
+            self.execute_cached(cache, operation, parameters, timeout,
+                                cache_ttl)
+
+    def execute_cached(self, cache, operation, parameters, timeout, ttl):
+        text, kind, tables = cache.parse(operation)
+        uncommitted = self.parent.uncommitted
+        key = None
+        if (kind == 'read' and ttl != 0 and not self.binary_views and
+                not self.stream_long_columns and
+                ALL_TABLES not in uncommitted and
+                uncommitted.isdisjoint(tables)):
+            key = result_key(text, parameters)
+        if key is None:
+            self.executemany(operation, [parameters], timeout)
+            if kind == 'end':
+                self.parent.end_transaction()
+            return
+        if self.hooked():
+            start = clock()
+        result = cache.get(key)
+        if result is None:
+            self.executemany(operation, [parameters], timeout)
+            if self.description is not None:
+                self.cache_result(cache, key, tables, ttl)
+            return
+        self.messages = []
+        self.inputsizes = None
+        self.settle()
+        with self.lock:
+            self.free_statement()
+        self.use_result(operation, result)
+        if self.hooked():
+            self.fire('on_execute', elapsed=clock() - start,
+                      server_time=0.0, rows=self.rowcount, cached=True)
+
+    def cache_result(self, cache, key, tables, ttl):
+        """Fetch the rest of the result set just executed and keep it in
+        the cache, unless it comes to more than the cache can hold, in
+        which case the rows fetched so far are left buffered."""
+        buffered = self.buffered
+        width = VALUE_BYTES * len(self.description)
+        rows = []
+        size = 0
+        while True:
+            size += value_bytes(buffered) + width * len(buffered)
+            rows.extend(buffered)
+            buffered.clear()
+            if size > cache.size:
+                buffered.extend(rows)
+                return
+            if not self.fill():
+                break
+        result = (self.description, self.column_types, rows, self.rowcount)
+        cache.put(key, tables, ttl, result, size)
+        operation = self.operation
+        self.settle()
+        with self.lock:
+            self.free_statement()
+        self.use_result(operation, result)
 
-    def execute(self, operation, parameters = ()):
-        self.executemany(operation, [parameters])
+    def use_result(self, operation, result):
+        self.description, self.column_types, rows, self.rowcount = result
+        self.operation = operation
+        self.buffered.extend(rows)
+        self.cached = True
 
-    def callproc(self, procname, parameters = ()):
+    def callproc(self, procname, parameters = (), timeout=None):
         stmt = 'call '+procname+'('+','.join(len(parameters)*('?',))+')'
-        return self.executemany(stmt, [parameters])
+        return self.executemany(stmt, [parameters], timeout)
 
     def values(self):
-        value = DataValue()
+        # the structure must match the API version the library was
+        # initialized with, as sqlany_get_column writes all of it
+        value = self.parent.DataValue()
         for i in range(self.api.sqlany_num_cols(self.get_stmt())):
             rc = self.api.sqlany_get_column(self.get_stmt(), i, byref(value))
             if rc < 0:
@@ -852,40 +3078,920 @@ class Cursor(object):
                 self.handleerror(*self.parent.error())
             yield (self.valueof)(value)
 
-    def rows(self):
+    def column_truncated(self, column):
+        self.handleerror(*self.parent.error())
+
+    def rowset_truncated(self, column):
+        self.handleerror(DataError,
+                         "value truncated in column %d" % column, -638)
+
+    def fill(self):
+        """Fetch the next block of rows into the buffer that all of the
+        fetch methods take their rows from: a whole rowset for a wide
+        fetch, otherwise up to prefetch rows.  Returns False at the end
+        of the result set."""
+        if not self.hooked():
+            return self.fill_block()
+        start, self.server_time = clock(), 0.0
+        count = len(self.buffered)
+        try:
+            more = self.fill_block(timed=True)
+        finally:
+            server_time, self.server_time = self.server_time, None
+        elapsed = clock() - start
+        rows = list(itertools.islice(self.buffered, count, None))
+        if rows:
+            self.fire('on_fetch_batch', elapsed=elapsed,
+                      server_time=server_time,
+                      decode_time=elapsed - server_time, rows=len(rows),
+                      bytes=value_bytes(rows))
+        return more
+
+    def fill_block(self, timed=False):
         if not self.description:
             self.handleerror(InterfaceError, "no result set", -872)
+        if self.cached:
+            # all of its rows were buffered
+            return False
+        if self.background:
+            return self.fill_background(timed)
+        if self.rowset is not None:
+            rows = self.fetch_rowset(timed)
+            if not rows:
+                return False
+            self.buffered.extend(self.rowset(rows, self.rowset_truncated))
+            return True
+        return self.fetch_rows(self.buffered.append, timed)
+
+    def fetch_rowset(self, timed=False):
+        """Fetch the next rows into the bound arrays, returning how many
+        were fetched, or 0 at the end of the result set.  If timed, the
+        time taken is added to server_time."""
+        if timed:
+            start = clock()
+        try:
+            with self.lock:
+                stmt = self.get_stmt()
+                if not self.api.sqlany_fetch_next(stmt):
+                    self.handleerror(*self.parent.error())
+                    return 0
+                self.handleerror(*self.parent.error())
+                return self.api.sqlany_fetched_rows(stmt)
+        finally:
+            if timed:
+                self.server_time += clock() - start
+
+    def fetch_rows(self, append, timed=False):
+        """Fetch and decode up to prefetch rows one at a time, passing each
+        to append.  Returns False if there were no more rows.  If timed,
+        the time spent fetching is added to server_time."""
+        stmt = self.get_stmt()
+        fetch_next = self.api.sqlany_fetch_next
+        if timed:
+            fetch_next = self.timed_fetch_next
+        decode = self.decoder
+        truncated = self.column_truncated
+        stream = self.column_reader
+        # a successful fetch can only have raised a warning, so the
+        # error is only read for every row when warnings are wanted
+        poll = self.collect_warnings
+        with self.lock:
+            for i in range(self.prefetch):
+                self.fetches += 1
+                if not fetch_next(stmt):
+                    self.handleerror(*self.parent.error())
+                    return i > 0
+                if poll:
+                    self.handleerror(*self.parent.error())
+                append(decode(stmt, truncated, stream))
+        return True
 
-        while self.api.sqlany_fetch_next(self.get_stmt()):
-            self.handleerror(*self.parent.error())
-            yield tuple(self.converter.gen(v3list(list(self.values()))))
-        self.handleerror(*self.parent.error())
+    def timed_fetch_next(self, stmt):
+        start = clock()
+        try:
+            return self.api.sqlany_fetch_next(stmt)
+        finally:
+            self.server_time += clock() - start
+
+    def fetch_block(self):
+        """Fetch the next block of rows for fill_background(), on the worker
+        thread: the index of the set of arrays a wide fetch filled and the
+        number of rows in it, or a list of rows fetched one at a time.
+        Returns None at the end of the result set."""
+        if self.rowsets is None:
+            rows = []
+            self.fetch_rows(rows.append)
+            return rows or None
+        k = self.rowset_index
+        self.rowset_index = 1 - k
+        with self.lock:
+            self.rowsets[k][2]()
+            n = self.fetch_rowset()
+        if not n:
+            return None
+        return k, n
+
+    def fill_background(self, timed=False):
+        """Take the block the worker thread has fetched, and have it fetch
+        the next one while this one is decoded and used.  If timed, the
+        time spent waiting for the worker is added to server_time."""
+        if timed:
+            start = clock()
+        if self.pending:
+            block = self.finish_fetch()
+        elif self.watch is not None:
+            # the first block of a statement with a timeout, fetched on
+            # this thread, which holds the lock, while it is watched
+            block = self.fetch_block()
+        else:
+            self.start_fetch(self.fetch_block)
+            block = self.finish_fetch()
+        if timed:
+            self.server_time += clock() - start
+        if block is None:
+            return False
+        self.start_fetch(self.fetch_block)
+        if isinstance(block, list):
+            self.buffered.extend(block)
+        else:
+            k, n = block
+            self.buffered.extend(self.rowsets[k][0](n, self.rowset_truncated))
+        return True
+
+    def start_fetch(self, call):
+        if self.worker is None:
+            requests, results = queue.Queue(), queue.Queue()
+            thread = threading.Thread(target=run_worker,
+                                      args=(requests, results))
+            thread.daemon = True
+            thread.start()
+            self.worker = (thread, requests, results)
+        self.worker[1].put(call)
+        self.pending = True
+
+    def finish_fetch(self):
+        self.pending = False
+        result, error = self.worker[2].get()
+        if error is not None:
+            raise error
+        return result
+
+    def settle(self):
+        """Wait for a fetch made in the background to finish, discarding
+        its rows, before the statement is used for anything else."""
+        if self.pending:
+            try:
+                self.finish_fetch()
+            except Exception:
+                pass
+
+    def rows(self):
+        buffered = self.buffered
+        while True:
+            while buffered:
+                yield buffered.popleft()
+            if not self.fill():
+                return
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        buffered = self.buffered
+        while not buffered:
+            if not self.fill():
+                raise StopIteration
+        return buffered.popleft()
+
+    next = __next__
 
     def fetchmany(self, size=None):
         if size is None:
             size = self.arraysize
-        return [row for i,row in zip(range(size), self.rows())]
+        buffered = self.buffered
+        rows = []
+        while len(rows) < size:
+            if not buffered:
+                if not self.fill():
+                    break
+                continue
+            n = size - len(rows)
+            if n >= len(buffered):
+                rows.extend(buffered)
+                buffered.clear()
+            else:
+                popleft = buffered.popleft
+                rows.extend([popleft() for i in range(n)])
+        return rows
 
     def fetchone(self):
-        rows = self.fetchmany(size=1)
-        if rows:
-            return rows[0]
-        return None
-
-    def fetchall(self):
-        return list(self.rows())
+        buffered = self.buffered
+        while not buffered:
+            if not self.fill():
+                return None
+        return buffered.popleft()
+
+    def fetchall(self, spill_threshold=None):
+        """Return the remaining rows of the result set as a list, or if
+        spill_threshold is given, as a SpooledResult that keeps up to
+        that many bytes of them in memory and writes the rest to a
+        temporary file."""
+        if spill_threshold is not None:
+            return self.fetch_spooled(spill_threshold)
+        buffered = self.buffered
+        rows = list(buffered)
+        buffered.clear()
+        while self.fill():
+            rows.extend(buffered)
+            buffered.clear()
+        return rows
+
+    def fetch_spooled(self, max_memory):
+        if self.binary_views:
+            self.handleerror(NotSupportedError,
+                             "binary views cannot be spooled", -1965)
+        result = SpooledResult(max_memory)
+        buffered = self.buffered
+        try:
+            while buffered or self.fill():
+                rows = list(buffered)
+                buffered.clear()
+                if any(isinstance(value, ColumnReader)
+                       for row in rows[:1] for value in row):
+                    self.handleerror(NotSupportedError,
+                                     "column readers cannot be spooled",
+                                     -1965)
+                result.extend(rows)
+            result.finish()
+        except:
+            result.close()
+            raise
+        return result
+
+    def blocks(self, limit=None):
+        """Yield the remaining rows of the result set, or the next limit
+        rows, in blocks for the fetch methods that build columns.  A block
+        is either a list of rows or, for a wide fetch, the number of rows
+        held by the arrays in rowset_columns, which stay valid until the
+        next block is taken."""
+        buffered = self.buffered
+        count = 0
+        while limit is None or count < limit:
+            if buffered:
+                n = len(buffered)
+                if limit is not None:
+                    n = min(n, limit - count)
+                count += n
+                yield [buffered.popleft() for i in range(n)]
+                continue
+            if self.rowset is None or self.background:
+                if not self.fill():
+                    return
+                continue
+            if self.hooked():
+                start, self.server_time = clock(), 0.0
+                try:
+                    fetched = self.fetch_rowset(True)
+                finally:
+                    server_time, self.server_time = self.server_time, None
+                if fetched:
+                    # decoded by the caller
+                    self.fire('on_fetch_batch', elapsed=clock() - start,
+                              server_time=server_time, decode_time=0.0,
+                              rows=fetched, bytes=None)
+            else:
+                fetched = self.fetch_rowset()
+            if not fetched:
+                return
+            n = fetched
+            if limit is not None:
+                n = min(n, limit - count)
+            if n < fetched:
+                # keep the rest of the rowset for the next fetch
+                rows = self.rowset(fetched, self.rowset_truncated)
+                buffered.extend(rows[n:])
+            count += n
+            yield n
+
+    def bound_values(self, column, n):
+        """Return the first n values of a column of a wide fetch as fetchall
+        would, with None for NULLs and any converter applied."""
+        buffer, nulls, read = self.rowset_columns[column]
+        values = read(n, column, self.rowset_truncated)
+        flags = nulls[:n]
+        if any(flags):
+            values = [None if null else value
+                      for value, null in zip(values, flags)]
+        converter = CONVERSION_CALLBACKS.get(self.column_types[column][1])
+        if converter is not None:
+            values = [converter(value) for value in values]
+        return values
+
+    def fetch_numpy(self, batch_rows=None, structured=False):
+        """Fetch up to batch_rows rows, or all the remaining rows, of the
+        result set into NumPy arrays, one per column.  Returns a dict of
+        masked arrays keyed by column name, with NULLs masked, or with
+        structured set, one masked array with a field per column.
+
+        Numeric and BIT columns are fetched into arrays of their own type,
+        straight from the arrays bound for a wide fetch when there is one.
+        Other columns are object arrays of the values fetchall() returns."""
+        try:
+            import numpy
+        except ImportError:
+            self.handleerror(NotSupportedError,
+                             "fetch_numpy requires numpy", -1965)
+        if not self.description:
+            self.handleerror(InterfaceError, "no result set", -872)
+        dtypes = [numpy_dtype(a_type, native_type)
+                  for a_type, native_type in self.column_types]
+        capacity = batch_rows
+        if capacity is None:
+            capacity = max(len(self.buffered), self.prefetch)
+        arrays = [numpy.empty(capacity, dtype) for dtype in dtypes]
+        masks = [numpy.zeros(capacity, bool) for dtype in dtypes]
+
+        def reserve(count, n):
+            # arrays only grow when all the remaining rows are fetched
+            if count + n > len(arrays[0]):
+                size = max(2 * len(arrays[0]), count + n)
+                for array in arrays + masks:
+                    array.resize(size, refcheck=False)
+
+        def store(rows, count):
+            # rows decoded to tuples, from the buffer or a narrow fetch
+            n = len(rows)
+            for j, column in enumerate(zip(*rows)):
+                flags = [value is None for value in column]
+                if any(flags):
+                    masks[j][count:count + n] = flags
+                    if dtypes[j] != 'O':
+                        column = [0 if value is None else value
+                                  for value in column]
+                arrays[j][count:count + n] = column
+
+        count = 0
+        for block in self.blocks(batch_rows):
+            if isinstance(block, list):
+                n = len(block)
+                reserve(count, n)
+                store(block, count)
+                count += n
+                continue
+            n = block
+            reserve(count, n)
+            for j, (buffer, nulls, read) in enumerate(self.rowset_columns):
+                masks[j][count:count + n] = numpy.frombuffer(nulls,
+                                                             numpy.intc, n)
+                if dtypes[j] != 'O':
+                    arrays[j][count:count + n] = numpy.frombuffer(buffer,
+                                                                  dtypes[j], n)
+                else:
+                    arrays[j][count:count + n] = self.bound_values(j, n)
+            count += n
+        for array in arrays + masks:
+            array.resize(count, refcheck=False)
+
+        names = [column[0] for column in self.description]
+        if structured:
+            data = numpy.empty(count, [(name, array.dtype)
+                                       for name, array in zip(names, arrays)])
+            mask = numpy.zeros(count, [(name, bool) for name in names])
+            for name, array, flags in zip(names, arrays, masks):
+                data[name] = array
+                mask[name] = flags
+            return numpy.ma.MaskedArray(data, mask=mask)
+        return dict((name, numpy.ma.MaskedArray(array, mask=flags))
+                    for name, array, flags in zip(names, arrays, masks))
+
+    def fetch_arrow_batches(self, batch_rows=None):
+        """Return the rest of the result set as ArrowBatches of up to
+        batch_rows rows each, to be read through the Arrow PyCapsule
+        interface, for example with pyarrow.RecordBatchReader.from_stream()
+        or polars.from_arrow()."""
+        if not self.description:
+            self.handleerror(InterfaceError, "no result set", -872)
+        return ArrowBatches(self, batch_rows or ARROW_BATCH_ROWS)
 
     def nextset(self):
         self.messages = []
-        return self.api.sqlany_get_next_result(self.get_stmt()) or None
+        if self.cached:
+            return None
+        self.settle()
+        with self.lock:
+            result = self.api.sqlany_get_next_result(self.get_stmt())
+            if result:
+                self.describe()
+        return result or None
 
     def setinputsizes(self, sizes):
+        """Declare the parameters of the next execute: one item for each,
+        either None, the maximum length of its values, a type object such
+        as STRING or NUMBER, or one of the Python types int, float, str,
+        bytes and Binary.  Typed parameters are bound once, to buffers
+        reserved for their largest values, instead of being inferred from
+        every value.  A value that does not fit its declared type is
+        bound as its own type instead."""
         self.messages = []
-        pass
+        self.inputsizes = list(sizes)
 
-    def setoutputsize(self, sizes, column):
+    def setoutputsize(self, size, column=None):
+        """Read the long column at index column, or every long column if
+        column is None, size bytes at a time when it is read through a
+        ColumnReader.  Values fetched whole are not affected."""
         self.messages = []
-        pass
+        self.outputsizes[column] = size
+
+    def chunk_size(self, column):
+        """Return the output size set for column, or None."""
+        size = self.outputsizes.get(column)
+        if size is None:
+            size = self.outputsizes.get(None)
+        return size
+
+    def column_reader(self, column, chunk_size=None):
+        """Return a ColumnReader over the value of column in the row most
+        recently fetched, or None if the value is NULL.  Rows must be
+        fetched one at a time, with stream_long_columns or a rowset_size
+        of 1, since otherwise the server is already past that row."""
+        if self.rowset is not None or self.prefetch != 1 or self.buffered:
+            self.handleerror(ProgrammingError,
+                             "column readers need rows fetched one at a time",
+                             -853)
+        if chunk_size is None:
+            chunk_size = self.chunk_size(column) or LOB_CHUNK_SIZE
+        reader = ColumnReader(self, column, chunk_size)
+        if reader.is_null:
+            return None
+        return reader
+
+
+def event_loop():
+    import asyncio
+    try:
+        return asyncio.get_running_loop()
+    except (AttributeError, RuntimeError):
+        return asyncio.get_event_loop()
+
+
+def complete(future, result, error):
+    if future.cancelled():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class ConnectionWorker(object):
+    """The thread that makes every call on one connection of the asyncio
+    interface.  Each call gets an asyncio future, completed on its event
+    loop when the call returns.  Cancelling the future of the call that
+    is running cancels it with sqlany_cancel; a call that has not started
+    yet is skipped."""
+
+    def __init__(self):
+        self.requests = queue.Queue()
+        self.connection = None
+        self.running = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            loop, future, call, args = request
+            if future.cancelled():
+                continue
+            self.running = future
+            try:
+                result, error = call(*args), None
+            except BaseException as e:
+                result, error = None, e
+            self.running = None
+            loop.call_soon_threadsafe(complete, future, result, error)
+
+    def submit(self, call, *args):
+        """Queue call(*args) and return a future of its result."""
+        loop = event_loop()
+        future = loop.create_future()
+        future.add_done_callback(self.cancelled)
+        self.requests.put((loop, future, call, args))
+        return future
+
+    def cancelled(self, future):
+        if (future.cancelled() and self.running is future and
+                self.connection is not None):
+            self.connection.cancel()
+
+    def stop(self):
+        """End the thread once the calls already queued are done."""
+        self.requests.put(None)
+
+
+def connect_async(*args, **kwargs):
+    """Connect to a database for use with asyncio.  Returns a future of an
+    AsyncConnection, all of whose calls are made on a thread of its own."""
+    worker = ConnectionWorker()
+    def connect():
+        try:
+            worker.connection = Connection(args, kwargs)
+        except BaseException:
+            worker.stop()
+            raise
+        return AsyncConnection(worker)
+    return worker.submit(connect)
+
+
+class AsyncConnection(object):
+    """A connection whose methods return asyncio futures, made by
+    connect_async()."""
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.connection = worker.connection
+
+    @property
+    def messages(self):
+        return self.connection.messages
+
+    def cursor(self):
+        return AsyncCursor(self, self.connection.cursor())
+
+    def commit(self):
+        return self.worker.submit(self.connection.commit)
+
+    def rollback(self):
+        return self.worker.submit(self.connection.rollback)
+
+    def cancel(self):
+        """Cancel the statement running on the connection, at once."""
+        return self.connection.cancel()
+
+    def close(self):
+        future = self.worker.submit(self.connection.close)
+        self.worker.stop()
+        return future
+
+
+class AsyncCursor(object):
+    """A cursor whose methods return asyncio futures, and which can be
+    iterated with async for.  Rows are fetched a block at a time."""
+
+    def __init__(self, connection, cursor):
+        self.connection = connection
+        self.cursor = cursor
+        self.worker = connection.worker
+        self.rows = deque()
+
+    def __getattr__(self, name):
+        # description, rowcount and settings such as arraysize are the
+        # cursor's own
+        return getattr(self.__dict__['cursor'], name)
+
+    def __setattr__(self, name, value):
+        if name in ('connection', 'cursor', 'worker', 'rows'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.cursor, name, value)
+
+    def done(self, result):
+        future = event_loop().create_future()
+        future.set_result(result)
+        return future
+
+    def run(self, call, *args):
+        # rows left over from iteration belong to the old result set
+        self.rows.clear()
+        return self.worker.submit(call, *args)
+
+    def execute(self, operation, parameters=(), timeout=None,
+                cache_ttl=None):
+        return self.run(self.cursor.execute, operation, parameters, timeout,
+                        cache_ttl)
+
+    def executemany(self, operation, seq_of_parameters, timeout=None):
+        return self.run(self.cursor.executemany, operation,
+                        seq_of_parameters, timeout)
+
+    def callproc(self, procname, parameters=(), timeout=None):
+        return self.run(self.cursor.callproc, procname, parameters, timeout)
+
+    def nextset(self):
+        return self.run(self.cursor.nextset)
+
+    def close(self):
+        return self.run(self.cursor.close)
+
+    def fetchone(self):
+        if self.rows:
+            return self.done(self.rows.popleft())
+        return self.worker.submit(self.cursor.fetchone)
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.cursor.arraysize
+        rows = [self.rows.popleft() for i in range(min(size, len(self.rows)))]
+        if len(rows) == size:
+            return self.done(rows)
+        return self.worker.submit(self.fetch_more, rows, size - len(rows))
+
+    def fetchall(self):
+        rows = list(self.rows)
+        self.rows.clear()
+        return self.worker.submit(self.fetch_more, rows, None)
+
+    def fetch_more(self, rows, size):
+        if size is None:
+            return rows + self.cursor.fetchall()
+        return rows + self.cursor.fetchmany(size)
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        if self.rows:
+            return self.done(self.rows.popleft())
+        return self.worker.submit(self.next_row)
+
+    def next_row(self):
+        rows = self.cursor.fetchmany(self.cursor.prefetch)
+        if not rows:
+            raise StopAsyncIteration
+        self.rows.extend(rows[1:])
+        return rows[0]
+
+
+class ConnectionPool(object):
+    """Connections made with the same connection parameters, kept open
+    between uses.  acquire() checks one out, waiting up to timeout seconds
+    while max_size are in use; closing it returns it to the pool, rolled
+    back.  Connections idle for longer than max_idle seconds are closed,
+    but never below min_size, and those open for longer than max_lifetime
+    seconds are closed instead of being handed out again.  Idle
+    connections are only checked for expiry when a connection is acquired
+    or released; no thread does it in the background.  A connection idle
+    for longer than validate_after seconds runs a trivial statement before
+    it is handed out, and is replaced if that fails.  Connections closed
+    for any of these reasons are replaced to keep min_size open."""
+
+    def __init__(self, min_size=0, max_size=10, timeout=30.0, max_idle=600.0,
+                 max_lifetime=None, validate_after=5.0, **kwargs):
+        if max_size < 1 or not 0 <= min_size <= max_size:
+            raise ValueError("need 0 <= min_size <= max_size and max_size >= 1")
+        self.kwargs = kwargs
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.validate_after = validate_after
+        self.lock = threading.Condition()
+        # (connection, opened, released), most recently released last
+        self.idle = deque()
+        # the query timeout and result cache each connection was opened
+        # with, restored when it is released
+        self.settings = {}
+        # connections open, being opened or checked out
+        self.size = 0
+        self.closed = False
+        self.waiting = 0
+        self.checkouts = self.timeouts = 0
+        self.created = self.discarded = 0
+        self.wait_time = self.max_wait = 0.0
+        try:
+            for i in range(min_size):
+                self.size += 1
+                connection = self.open()
+                self.idle.append((connection, clock(), clock()))
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self): return self
+
+    def __exit__(self, exc, value, tb):
+        self.close()
+
+    def open(self):
+        try:
+            connection = Connection((), self.kwargs)
+        except BaseException:
+            with self.lock:
+                self.size -= 1
+                self.lock.notify()
+            raise
+        with self.lock:
+            self.created += 1
+            self.settings[connection] = (connection.query_timeout,
+                                         connection.result_cache)
+        return connection
+
+    def discard(self, connection):
+        try:
+            if connection.c:
+                connection.close()
+        except Error:
+            pass
+        with self.lock:
+            self.size -= 1
+            self.discarded += 1
+            self.settings.pop(connection, None)
+            self.lock.notify()
+        self.replenish()
+
+    def replenish(self):
+        """Open idle connections until min_size are open again."""
+        while True:
+            with self.lock:
+                if self.closed or self.size >= self.min_size:
+                    return
+                self.size += 1
+            try:
+                connection = self.open()
+            except Error:
+                return
+            with self.lock:
+                if not self.closed:
+                    self.idle.append((connection, clock(), clock()))
+                    self.lock.notify()
+                    continue
+            self.discard(connection)
+
+    def alive(self, connection):
+        api = connection.api
+        try:
+            stmt = api.sqlany_execute_direct(connection.con(), b"select 1")
+        except Error:
+            return False
+        if not stmt:
+            return False
+        api.sqlany_free_stmt(stmt)
+        return True
+
+    def expired(self):
+        """Take the connections idle for too long out of the pool."""
+        now = clock()
+        expired = []
+        with self.lock:
+            while self.idle and self.size - len(expired) > self.min_size:
+                connection, opened, released = self.idle[0]
+                if self.max_idle is None or now - released < self.max_idle:
+                    break
+                self.idle.popleft()
+                expired.append(connection)
+        return expired
+
+    def checkout(self, deadline):
+        """Take an idle connection, or None after reserving room for a new
+        one, waiting until the deadline for either."""
+        with self.lock:
+            while True:
+                if self.closed:
+                    raise InterfaceError("connection pool is closed", -101)
+                if self.idle:
+                    return self.idle.pop()
+                if self.size < self.max_size:
+                    self.size += 1
+                    return None
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - clock()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolTimeoutError(
+                            "timed out waiting for a pooled connection")
+                self.waiting += 1
+                try:
+                    self.lock.wait(remaining)
+                finally:
+                    self.waiting -= 1
+
+    def acquire(self, timeout=None):
+        """Check out a connection, waiting up to timeout seconds, by default
+        the pool's timeout, for one to be free.  A pool made with a timeout
+        of None waits for ever."""
+        for connection in self.expired():
+            self.discard(connection)
+        if timeout is None:
+            timeout = self.timeout
+        start = clock()
+        deadline = None if timeout is None else start + timeout
+        while True:
+            entry = self.checkout(deadline)
+            if entry is None:
+                connection, opened = self.open(), clock()
+                break
+            connection, opened, released = entry
+            now = clock()
+            if self.max_lifetime is None or now - opened < self.max_lifetime:
+                if (self.validate_after is None or
+                        now - released < self.validate_after or
+                        self.alive(connection)):
+                    break
+            self.discard(connection)
+        waited = clock() - start
+        with self.lock:
+            self.checkouts += 1
+            self.wait_time += waited
+            self.max_wait = max(self.max_wait, waited)
+        return PooledConnection(self, connection, opened)
+
+    def release(self, connection, opened):
+        reusable = False
+        if connection.c:
+            try:
+                for cursor in list(connection.cursors):
+                    cursor.close()
+                # nothing the borrower set carries over to the next one
+                connection.errorhandler = None
+                connection.hooks = {}
+                connection.messages = []
+                reusable = bool(connection.rollback())
+                with self.lock:
+                    settings = self.settings.get(connection)
+                if settings is not None:
+                    connection.query_timeout, connection.result_cache = \
+                        settings
+            except Error:
+                pass
+        now = clock()
+        if self.max_lifetime is not None and now - opened >= self.max_lifetime:
+            reusable = False
+        with self.lock:
+            if reusable and not self.closed:
+                self.idle.append((connection, opened, now))
+                self.lock.notify()
+                reusable = None
+        if reusable is not None:
+            self.discard(connection)
+        for connection in self.expired():
+            self.discard(connection)
+
+    def close(self):
+        """Close the idle connections; those checked out are closed when
+        they are returned."""
+        with self.lock:
+            self.closed = True
+            idle = [entry[0] for entry in self.idle]
+            self.idle.clear()
+            self.lock.notify_all()
+        for connection in idle:
+            self.discard(connection)
+
+    def stats(self):
+        """Return a dict of the pool's size and counters.  wait_time is the
+        total time spent in acquire() and max_wait the longest; created
+        and discarded count the connections opened and closed."""
+        with self.lock:
+            return dict(size=self.size, idle=len(self.idle),
+                        in_use=self.size - len(self.idle),
+                        waiting=self.waiting, checkouts=self.checkouts,
+                        timeouts=self.timeouts, created=self.created,
+                        discarded=self.discarded, wait_time=self.wait_time,
+                        max_wait=self.max_wait)
+
+
+class PooledConnection(object):
+    """A connection checked out of a ConnectionPool.  It behaves as the
+    connection, except that close() returns it to the pool.  As with a
+    connection, a with block gives a cursor, and commits if it succeeds
+    and rolls back if it raises; either way the connection is then
+    returned."""
+
+    def __init__(self, pool, connection, opened):
+        self.pool = pool
+        self.connection = connection
+        self.opened = opened
+
+    def __getattr__(self, name):
+        connection = self.__dict__.get('connection')
+        if connection is None:
+            raise InterfaceError("not connected", -101)
+        return getattr(connection, name)
+
+    def __del__(self):
+        if self.__dict__.get('connection') is not None:
+            self.close()
+
+    def close(self):
+        connection, self.connection = self.connection, None
+        if connection is not None:
+            self.pool.release(connection, self.opened)
+
+    def __enter__(self): return self.cursor()
+
+    def __exit__(self, exc, value, tb):
+        try:
+            if exc:
+                self.rollback()
+            else:
+                self.commit()
+        finally:
+            self.close()
 
 
 def Date(*ymd):